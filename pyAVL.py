@@ -1,17 +1,30 @@
 from graphviz import Digraph
 from IPython.display import Image, display
+from bisect import bisect_left, bisect_right
+from pySched import Scheduler
+from pyArrays import keyDtype
+from pyJoin import joinNodes
 import time
-import random
 
-def fakeConflict(self):
-    if self.simulate == True:
-        for i in range(random.randint(0,1000000)):
-            pass
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class AVL(object):
-    def __init__(self, simulate=False):
+    def __init__(self, simulate=False, scheduler=None):
+        """
+        scheduler is a pySched.Scheduler that controls the thread interleaving at the named yield points,
+        simulate=True uses a scheduler that randomly preempts free-running threads instead
+        """
+        if scheduler is None and simulate:
+            scheduler = Scheduler(preempt=0.5)
         self.root = None
         self.simulate = simulate
+        self.scheduler = scheduler
+        # cached min and max nodes, None when the tree is empty
+        self.minNode = None
+        self.maxNode = None
 
     def get(self, dkey):
         return self.__getNode(self.root, dkey)
@@ -19,16 +32,144 @@ class AVL(object):
     def put(self, dkey, dval = None):
         self.__putNode(self.root, dkey, str(dkey) if dval is None else dval)
         self.__rebalance()
+        if self.minNode is None or dkey < self.minNode.key or dkey > self.maxNode.key:
+            self.__resetExtrema()
 
     def min(self):
-        return self.__getMinNode(self.root)
+        return self.minNode
 
     def max(self):
-        return self.__getMaxNode(self.root)
+        return self.maxNode
 
     def remove(self, dkey):
         self.__removeNode(self.root, dkey)
         self.__rebalance()
+        # removal can move keys between nodes, so the cached nodes are looked up again
+        self.__resetExtrema()
+
+    def peek_min(self):
+        """
+        return the (key, val) pair with the minimum key in O(1), None if the tree is empty
+        """
+        return None if self.minNode is None else (self.minNode.key, self.minNode.val)
+
+    def peek_max(self):
+        """
+        return the (key, val) pair with the maximum key in O(1), None if the tree is empty
+        """
+        return None if self.maxNode is None else (self.maxNode.key, self.maxNode.val)
+
+    def pop_min(self):
+        """
+        remove and return the (key, val) pair with the minimum key, None if the tree is empty
+        """
+        item = self.peek_min()
+        if item is not None:
+            self.remove(item[0])
+        return item
+
+    def pop_max(self):
+        """
+        remove and return the (key, val) pair with the maximum key, None if the tree is empty
+        """
+        item = self.peek_max()
+        if item is not None:
+            self.remove(item[0])
+        return item
+
+    def range(self, lo=None, hi=None):
+        """
+        return (key, val) pairs with lo <= key < hi in key order,
+        None means unbounded
+        """
+        return [(dnode.key, dnode.val) for dnode in self.__rangeNodes(self.root, lo, hi)]
+
+    def get_array(self, keys, default=None, dtype=object):
+        """
+        vectorized get: probe an array of keys with a single walk of the tree,
+        return an array of values with default for missing keys
+        """
+        keys = np.asarray(keys)
+        order = np.argsort(keys, kind='stable')
+        out = np.empty(len(keys), dtype=dtype)
+        out[order] = self.__probeSorted(self.root, keys[order].tolist(), default)
+        return out
+
+    def range_to_array(self, lo=None, hi=None, dtype=None):
+        """
+        return (keys, vals) arrays for lo <= key < hi in key order
+        """
+        dkeys = []
+        dvals = []
+        for dnode in self.__rangeNodes(self.root, lo, hi):
+            dkeys.append(dnode.key)
+            dvals.append(dnode.val)
+        return np.array(dkeys, dtype=keyDtype(dkeys)), np.array(dvals, dtype=dtype)
+
+    def to_arrays(self, dtype=None):
+        """
+        export all keys and values into contiguous arrays
+        """
+        return self.range_to_array(None, None, dtype)
+
+    def split(self, dkey):
+        """
+        move every key >= dkey into a new tree and return it, in O(log n)
+        """
+        left, right = self.__splitNode(self.root, dkey)
+        self.root = self.__detach(left)
+        dtree = AVL(self.simulate, self.scheduler)
+        dtree.root = self.__detach(right)
+        self.__resetExtrema()
+        dtree.__resetExtrema()
+        return dtree
+
+    def join(self, dtree):
+        """
+        move every key of dtree into this tree, in O(log n),
+        all keys of dtree must be greater than the keys of this tree
+        """
+        if dtree.root is None:
+            return
+        if self.root is not None and not self.__getMaxNode(self.root).key < dtree.__getMinNode(dtree.root).key:
+            raise ValueError("key ranges overlap, use union")
+        m, rest = self.__popMinNode(self.__detach(dtree.root))
+        dtree.root = None
+        self.root = self.__detach(self.__joinNodes(self.root, m, self.__detach(rest)))
+        self.__resetExtrema()
+        dtree.__resetExtrema()
+
+    def union(self, dtree):
+        """
+        return a new tree with the keys of both trees (values of dtree win), in O(n)
+        """
+        items = []
+        mine = self.__rangeNodes(self.root, None, None)
+        theirs = self.__rangeNodes(dtree.root, None, None)
+        a = next(mine, None)
+        b = next(theirs, None)
+        while a is not None or b is not None:
+            if b is None or (a is not None and a.key < b.key):
+                items.append((a.key, a.val))
+                a = next(mine, None)
+            else:
+                items.append((b.key, b.val))
+                if a is not None and a.key == b.key:
+                    a = next(mine, None)
+                b = next(theirs, None)
+        utree = AVL(self.simulate, self.scheduler)
+        utree.root = self.__buildNodes(items, 0, len(items), None)
+        utree.__resetExtrema()
+        return utree
+
+    def rebuild(self):
+        """
+        rebuild a perfectly balanced tree from the current keys, in O(n),
+        nodes returned by earlier get/min/max calls are no longer part of the tree
+        """
+        items = [(dnode.key, dnode.val) for dnode in self.__rangeNodes(self.root, None, None)]
+        self.root = self.__buildNodes(items, 0, len(items), None)
+        self.__resetExtrema()
 
     def print(self):
         self.__prettyPrintTree(self.root)
@@ -37,9 +178,14 @@ class AVL(object):
         return self.__strTree(self.root)
 
     def __rebalance(self):
+        # a removal can leave several ancestors unbalanced, one rotation per pass
         unbalanced = self.__balanceCheck(self.root)
-        if unbalanced is not None:
-            self.root = self.__getRoot(self.__autoRotate(unbalanced))
+        while unbalanced is not None:
+            subroot = self.__autoRotate(unbalanced)
+            # the rotation only fixed the heights inside the subtree
+            self.__fixHeight(subroot)
+            self.root = self.__getRoot(subroot)
+            unbalanced = self.__balanceCheck(self.root)
 
     def __strTree(self, droot):
         """
@@ -86,6 +232,46 @@ class AVL(object):
                     else:
                         dnode = dnode.right
 
+    def __rangeNodes(self, droot, lo, hi):
+        """
+        in-order generator of the nodes with lo <= key < hi,
+        skipping the subtrees outside the range
+        """
+        stack = []
+        dnode = droot
+        while stack or dnode is not None:
+            if dnode is not None:
+                if lo is not None and dnode.key < lo:
+                    dnode = dnode.right
+                else:
+                    stack.append(dnode)
+                    dnode = dnode.left
+            else:
+                dnode = stack.pop()
+                if hi is not None and dnode.key >= hi:
+                    return
+                yield dnode
+                dnode = dnode.right
+
+    def __probeSorted(self, droot, skeys, default):
+        """
+        return the values of the sorted probe keys skeys,
+        each subtree is only visited if some probe key can be in it
+        """
+        svals = [default] * len(skeys)
+        stack = [(droot, 0, len(skeys))] if droot is not None and skeys else []
+        while stack:
+            dnode, lo, hi = stack.pop()
+            i = bisect_left(skeys, dnode.key, lo, hi)
+            j = bisect_right(skeys, dnode.key, i, hi)
+            for k in range(i, j):
+                svals[k] = dnode.val
+            if lo < i and dnode.left is not None:
+                stack.append((dnode.left, lo, i))
+            if j < hi and dnode.right is not None:
+                stack.append((dnode.right, j, hi))
+        return svals
+
     def __putNode(self, droot, dkey, dval):
         """
         if dkey presents, perform update,
@@ -94,7 +280,8 @@ class AVL(object):
 
         tnode = self.__getNode(droot, dkey)
         
-        fakeConflict(self)
+        if self.scheduler is not None:
+            self.scheduler.point("put")
         
         if tnode is None:
             # init root
@@ -112,30 +299,29 @@ class AVL(object):
 
     def __getMinNode(self, droot):
         """
-        return the node with minimum key, including droot
+        return the node with minimum key, including droot,
+        it is the end of the left spine
         """
-        m = droot
         dnode = droot
-
-        if droot is not None:
-            while dnode.left != None:
+        if dnode is not None:
+            while dnode.left is not None:
                 dnode = dnode.left
-                if dnode.key < m.key:
-                    m = dnode
-        return m
+        return dnode
 
     def __getMaxNode(self, droot):
         """
-        return the node with maximum key, including droot
+        return the node with maximum key, including droot,
+        it is the end of the right spine
         """
-        m = droot
         dnode = droot
-        if droot is not None:
-            while dnode.right != None:
+        if dnode is not None:
+            while dnode.right is not None:
                 dnode = dnode.right
-                if dnode.key > m.key:
-                    m = dnode
-        return m
+        return dnode
+
+    def __resetExtrema(self):
+        self.minNode = self.__getMinNode(self.root)
+        self.maxNode = self.__getMaxNode(self.root)
 
     def __removeNode(self, droot, dkey):
         """
@@ -143,28 +329,20 @@ class AVL(object):
         otherwise return None (means failure)
         """
         tnode = self.__getNode(droot, dkey)
-        if tnode is not None:
+        if tnode is not None and tnode.key == dkey:
             # found a node: just remove it
-            if tnode.parent == None:
-                # it's ROOT
-                if tnode.left == None or tnode.right == None:
-                    temp = tnode.left if tnode.left != None else tnode.right
-                    if temp == None:
-                        # 0 Children
-                        self.root = None
-                    else:
-                        # 1 Child
-                        temp.parent = None
-                        self.root = temp
+            if tnode.parent == None and (tnode.left == None or tnode.right == None):
+                # it's ROOT with 0 or 1 child, 2 children are handled like any other node
+                temp = tnode.left if tnode.left != None else tnode.right
+                if temp == None:
+                    # 0 Children
+                    self.root = None
                 else:
-                    # 2 children
-                    temp = self.__getMinNode(tnode.right)
-                    tnode.left.parent = temp
-                    temp.left = tnode.left
+                    # 1 Child
                     temp.parent = None
                     self.root = temp
             else:
-                if tnode.height == 0:
+                if tnode.left == None and tnode.right == None:
                     # no children, simply remove itself
                     p = tnode.parent
                     if tnode.key == p.key:
@@ -371,11 +549,13 @@ class AVL(object):
             nnl = ddnode.left.height if ddnode.left != None else -1
             nnr = ddnode.right.height if ddnode.right != None else -1
             if nnl < nnr:
-                fakeConflict(self)
+                if self.scheduler is not None:
+                    self.scheduler.point("rotateRR")
                 # print("RR")
                 return self.__rotateRR(dnode)
             else:
-                fakeConflict(self)
+                if self.scheduler is not None:
+                    self.scheduler.point("rotateRL")
                 # print("RL")
                 return self.__rotateRL(dnode)
         else:
@@ -384,14 +564,76 @@ class AVL(object):
             nnl = ddnode.left.height if ddnode.left != None else -1
             nnr = ddnode.right.height if ddnode.right != None else -1
             if nnl < nnr:
-                fakeConflict(self)
+                if self.scheduler is not None:
+                    self.scheduler.point("rotateLR")
                 # print("LR")
                 return self.__rotateLR(dnode)
             else:
-                fakeConflict(self)
+                if self.scheduler is not None:
+                    self.scheduler.point("rotateLL")
                 # print("LL")
                 return self.__rotateLL(dnode)
 
+    def __height(self, dnode):
+        return -1 if dnode is None else dnode.height
+
+    def __detach(self, dnode):
+        if dnode is not None:
+            dnode.parent = None
+        return dnode
+
+    def __linkNode(self, dnode, dleft, dright):
+        """
+        make dleft and dright the children of dnode, fix its height, return dnode
+        """
+        dnode.left = dleft
+        dnode.right = dright
+        if dleft is not None:
+            dleft.parent = dnode
+        if dright is not None:
+            dright.parent = dnode
+        dnode.height = max(self.__height(dleft), self.__height(dright)) + 1
+        return dnode
+
+    def __joinNodes(self, dleft, dnode, dright):
+        """
+        join two subtrees with keys dleft < dnode.key < dright, in O(height difference)
+        """
+        return joinNodes(self.__linkNode, self.__height, dleft, dnode, dright)
+
+    def __splitNode(self, droot, dkey):
+        """
+        split a subtree into (keys < dkey, keys >= dkey)
+        """
+        if droot is None:
+            return None, None
+        dleft = droot.left
+        dright = droot.right
+        if dkey <= droot.key:
+            ll, lr = self.__splitNode(dleft, dkey)
+            return ll, self.__joinNodes(lr, droot, dright)
+        rl, rr = self.__splitNode(dright, dkey)
+        return self.__joinNodes(dleft, droot, rl), rr
+
+    def __popMinNode(self, droot):
+        """
+        remove the minimum node of a subtree, return (minimum node, new subtree root)
+        """
+        if droot.left is None:
+            return droot, droot.right
+        m, rest = self.__popMinNode(droot.left)
+        return m, self.__joinNodes(rest, droot, droot.right)
+
+    def __buildNodes(self, items, lo, hi, parent):
+        """
+        build a balanced subtree from the sorted (key, val) pairs items[lo:hi]
+        """
+        if lo >= hi:
+            return None
+        mid = (lo + hi) // 2
+        dnode = Node(items[mid][0], items[mid][1], parent)
+        return self.__linkNode(dnode, self.__buildNodes(items, lo, mid, dnode), self.__buildNodes(items, mid + 1, hi, dnode))
+
     def __getRoot(self, dnode):
         """
         trace back to the actual top ROOT node
@@ -421,6 +663,9 @@ class AVL(object):
             display(Image(G.render()))
 
 class Node(object):
+    # no __dict__: a node is a single object for the garbage collector
+    __slots__ = ("key", "val", "height", "parent", "left", "right")
+
     def __init__(self, dkey, dval = None, parent = None):
         self.key = dkey  # comparable, assume int
         self.val = dval  # any type, None means this node is conceptually not present
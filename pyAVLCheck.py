@@ -0,0 +1,904 @@
+# Invariant checker, linearizability stress test and model checks for the trees of this package
+# Linearizability is checked per key (it is a local property) with the Wing & Gong search
+# Reference: http://www.cs.cmu.edu/~wing/publications/WingGong93.pdf
+
+import asyncio
+import io
+import math
+import os
+import random
+import threading
+import time
+import sys
+import tempfile
+
+from pyAVL import AVL
+from pyConAVL import ConAVL, TXN_G, TXN_P, TXN_R
+from pyCowAVL import CowAVL
+from pyFrozenAVL import FrozenAVL
+from pyKVServer import GET_BATCH, KVClient, KVServer
+from pyLockProfile import TAGGED_OPS, LockProfiler, ProfiledLock
+from pySched import Scheduler
+from pyShape import ShapeMonitor, depthPolicy, shapeStats
+from pyTTL import TTLConAVL
+from pyMVCC import MVCCConAVL
+from pyMmapAVL import MmapAVL
+from pyValueStore import Arena, KeySet, PRESENT
+
+# History operation codes
+
+OP_G = 0 # get (OP_G, KEY) -> value
+OP_P = 1 # put (OP_P, KEY, VAL)
+OP_R = 2 # remove (OP_R, KEY)
+
+def checkInvariants(tree, strict=True):
+    """
+    Validates the BST order, parent pointers, heights and AVL balance of a quiescent tree
+    (CowAVL nodes have no parent pointer).
+    ConAVL balance is relaxed around routing nodes (see reference paper): with strict=False
+    stored heights and balance are not checked, only that the depth stays within 2 * log2(n + 1) + 1.
+    Returns a list of violations, empty if the tree is valid.
+    """
+    errors = []
+    if isinstance(tree, ConAVL):
+        # heights count nodes (leaf is 1), routing nodes must have two children
+        droot, empty, routing = tree.root.right, 0, True
+    elif isinstance(tree, CowAVL):
+        droot, empty, routing = tree.root, 0, False
+    else:
+        # heights count edges (leaf is 0)
+        droot, empty, routing = tree.root, -1, False
+
+    # iterative post-order: (node, parent, lo, hi, visited)
+    heights = {}
+    count = 0
+    stack = [(droot, None, None, None, False)] if droot is not None else []
+    while stack:
+        dnode, parent, lo, hi, visited = stack.pop()
+        if not visited:
+            if not isinstance(tree, CowAVL) and dnode.parent is not parent and not (parent is None and dnode.parent is tree.root):
+                errors.append("key %s: wrong parent pointer" % (dnode.key,))
+            if (lo is not None and not lo < dnode.key) or (hi is not None and not dnode.key < hi):
+                errors.append("key %s: out of order" % (dnode.key,))
+            stack.append((dnode, parent, lo, hi, True))
+            if dnode.left is not None:
+                stack.append((dnode.left, dnode, lo, dnode.key, False))
+            if dnode.right is not None:
+                stack.append((dnode.right, dnode, dnode.key, hi, False))
+        else:
+            hl = heights.pop(id(dnode.left), empty) if dnode.left is not None else empty
+            hr = heights.pop(id(dnode.right), empty) if dnode.right is not None else empty
+            height = max(hl, hr) + 1
+            if strict and dnode.height != height:
+                errors.append("key %s: height %s, expected %s" % (dnode.key, dnode.height, height))
+            if strict and abs(hl - hr) > 1:
+                errors.append("key %s: unbalanced (%s, %s)" % (dnode.key, hl, hr))
+            if routing and dnode.val is None and (dnode.left is None or dnode.right is None):
+                errors.append("key %s: routing node not unlinked" % (dnode.key,))
+            heights[id(dnode)] = height
+            count += 1
+
+    if not strict and droot is not None:
+        depth = heights[id(droot)] - empty
+        if depth > 2 * math.log2(count + 1) + 1:
+            errors.append("depth %s exceeds the relaxed bound for %s nodes" % (depth, count))
+    return errors
+
+def checkLinearizable(history, init=None):
+    """
+    Checks a single key history against a sequential register.
+    history is a list of (invoke, response, op, arg, result), with op one of OP_G, OP_P, OP_R.
+    Returns True if some linearization explains every result.
+    """
+    ops = sorted(history, key=lambda h: h[0])
+    n = len(ops)
+    full = (1 << n) - 1
+    seen = set()
+    # DFS over (linearized set, register value)
+    stack = [(0, init)]
+    while stack:
+        done, state = stack.pop()
+        if done == full:
+            return True
+        if (done, state) in seen:
+            continue
+        seen.add((done, state))
+        # an op can go next if it was invoked before every pending op responded
+        bound = min(ops[i][1] for i in range(n) if not done >> i & 1)
+        for i in range(n):
+            if done >> i & 1 or ops[i][0] > bound:
+                continue
+            invoke, response, op, arg, result = ops[i]
+            if op == OP_G:
+                if result == state:
+                    stack.append((done | 1 << i, state))
+            elif op == OP_P:
+                stack.append((done | 1 << i, arg))
+            else:
+                stack.append((done | 1 << i, None))
+    return False
+
+def stressTest(nthreads=4, nops=2000, nkeys=32, seed=0, tree=None, min_ops_per_sec=None, scheduler=None):
+    """
+    Runs a randomized concurrent get/put/remove history against tree (an empty ConAVL by default),
+    then checks every key history for linearizability and the final tree for invariants.
+    With a pySched.Scheduler the threads are interleaved deterministically, and a failure reports
+    the schedule to replay.
+    Raises AssertionError on a violation, or if the throughput is below min_ops_per_sec.
+    Returns a report dict.
+    """
+    if tree is None:
+        tree = ConAVL(scheduler=scheduler)
+    histories = [[] for i in range(nthreads)]
+    clock = time.perf_counter
+
+    def worker(tid):
+        rnd = random.Random(seed * 1000 + tid)
+        log = histories[tid]
+        for i in range(nops):
+            key = rnd.randrange(nkeys)
+            op = rnd.choice((OP_G, OP_G, OP_P, OP_R))
+            if op == OP_G:
+                invoke = clock()
+                result = tree.get(key)
+                log.append((invoke, clock(), op, key, None, result))
+            elif op == OP_P:
+                val = "%d.%d" % (tid, i)
+                invoke = clock()
+                tree.put(key, val)
+                log.append((invoke, clock(), op, key, val, None))
+            else:
+                invoke = clock()
+                tree.remove(key)
+                log.append((invoke, clock(), op, key, None, None))
+
+    start = clock()
+    if scheduler is not None:
+        scheduler.run([lambda i=i: worker(i) for i in range(nthreads)])
+    else:
+        tpool = [threading.Thread(target=worker, args=(i,)) for i in range(nthreads)]
+        for t in tpool:
+            t.start()
+        for t in tpool:
+            t.join()
+    elapsed = clock() - start
+
+    # stop a maintenance thread and repair the damage queued by a deferred tree before checking the shape
+    tree.stop_maintenance()
+    tree.rebalance()
+
+    # final reads catch lost updates that no concurrent get observed
+    for key in range(nkeys):
+        invoke = clock()
+        histories[0].append((invoke, clock(), OP_G, key, None, tree.get(key)))
+
+    perkey = {}
+    for log in histories:
+        for invoke, response, op, key, arg, result in log:
+            perkey.setdefault(key, []).append((invoke, response, op, arg, result))
+
+    # the tree is quiescent and repaired: heights and balance must be exact
+    errors = checkInvariants(tree)
+    for key in sorted(perkey):
+        if not checkLinearizable(perkey[key]):
+            errors.append("key %s: history is not linearizable" % (key,))
+    report = {
+        "ops": nthreads * nops,
+        "seconds": elapsed,
+        "ops_per_sec": nthreads * nops / elapsed,
+        "errors": errors,
+    }
+    if errors and scheduler is not None:
+        errors.append("replay with Scheduler(schedule=%s)" % (scheduler.choices(),))
+    assert not errors, "\n".join(errors)
+    if min_ops_per_sec is not None:
+        assert report["ops_per_sec"] >= min_ops_per_sec, "throughput regression: %.0f ops/s < %.0f ops/s" % (report["ops_per_sec"], min_ops_per_sec)
+    return report
+
+def ttlTest(nops=2000, nkeys=64, seed=0, deferred=False):
+    """
+    Checks TTLConAVL against a dict under a manual clock: get and range hide the expired entries,
+    expire() removes every entry whose deadline tick has ended and keeps the others, and once every
+    deadline has passed the expiry index is empty and compact() leaves no routing node.
+    Raises AssertionError on a violation.
+    """
+    rnd = random.Random(seed)
+    now = [0.0]
+    tree = TTLConAVL(resolution=0.01, clock=lambda: now[0], deferred=deferred)
+    model = {}  # key -> (value, deadline)
+    for i in range(nops):
+        key = rnd.randrange(nkeys)
+        r = rnd.random()
+        if r < 0.5:
+            ttl = None if r < 0.1 else rnd.random() * 0.2
+            tree.put(key, i, ttl)
+            model[key] = (i, None if ttl is None else now[0] + ttl)
+        elif r < 0.6:
+            tree.remove(key)
+            model.pop(key, None)
+        elif r < 0.9:
+            val, deadline = model.get(key, (None, None))
+            expected = val if deadline is None or deadline > now[0] else None
+            assert tree.get(key) == expected, "ttl key %s: got %s, expected %s" % (key, tree.get(key), expected)
+        elif r < 0.97:
+            now[0] += rnd.random() * 0.05
+        else:
+            tree.expire()
+            tick = int(now[0] / tree.resolution)
+            for key, entry in tree.tree.range():
+                assert entry.deadline is None or int(entry.deadline / tree.resolution) >= tick, "ttl key %s: not expired" % (key,)
+            for key, (val, deadline) in model.items():
+                if deadline is None or deadline > now[0]:
+                    assert tree.tree.get(key) is not None, "ttl key %s: expired early" % (key,)
+            errors = checkInvariants(tree.tree)
+            assert not errors, "\n".join(errors)
+        if i % 100 == 0:
+            live = sorted((key, val) for key, (val, deadline) in model.items() if deadline is None or deadline > now[0])
+            assert tree.range() == live, "ttl range differs from the model"
+    now[0] += 1.0
+    tree.expire()
+    assert all(entry.deadline is None for key, entry in tree.tree.range()), "ttl entries left after every deadline passed"
+    assert tree.expiries.range() == [], "ttl expiry index not empty"
+    live = len(tree.tree.range())
+    tree.compact()
+    stack, routing = [tree.tree.root.right], 0
+    while stack:
+        node = stack.pop()
+        if node is not None:
+            routing += node.val is None
+            stack += [node.left, node.right]
+    assert routing == 0 and len(tree.tree.range()) == live, "ttl compact left %d routing nodes" % routing
+    errors = checkInvariants(tree.tree)
+    assert not errors, "\n".join(errors)
+
+def mvccTest(nops=2000, nkeys=64, seed=0):
+    """
+    Checks MVCCConAVL against a dict: get reads the latest write, every open snapshot keeps reading
+    the state it was taken in, and once the snapshots are closed vacuum() leaves one version per live key.
+    Then checks that ConAVL.scan misses no key that stays present while writers rotate the tree.
+    Raises AssertionError on a violation.
+    """
+    rnd = random.Random(seed)
+    tree = MVCCConAVL()
+    model = {}
+    snapshots = []  # (Snapshot, copy of the model)
+    for i in range(nops):
+        key = rnd.randrange(nkeys)
+        r = rnd.random()
+        if r < 0.45:
+            tree.put(key, i)
+            model[key] = i
+        elif r < 0.7:
+            tree.remove(key)
+            model.pop(key, None)
+        elif r < 0.85:
+            assert tree.get(key) == model.get(key), "mvcc key %s: got %s, expected %s" % (key, tree.get(key), model.get(key))
+        elif r < 0.9:
+            snapshots.append((tree.snapshot(), dict(model)))
+        elif r < 0.95 and snapshots:
+            snapshot, state = snapshots.pop(rnd.randrange(len(snapshots)))
+            assert snapshot.range() == sorted(state.items()), "mvcc snapshot changed"
+            assert snapshot.get(key) == state.get(key), "mvcc snapshot key %s changed" % (key,)
+            snapshot.close()
+        else:
+            tree.vacuum()
+    for snapshot, state in snapshots:
+        assert snapshot.range() == sorted(state.items()), "mvcc snapshot changed"
+        snapshot.close()
+    tree.vacuum()
+    assert [key for key, head in tree.tree.range()] == sorted(model), "mvcc vacuum left removed keys"
+    assert all(head.older is None for key, head in tree.tree.range()), "mvcc vacuum left old versions"
+
+    # read your writes: a put that returned is seen by get while a write to another key is in flight
+    tree = MVCCConAVL()
+    tree.put(nkeys, "old")
+    sub = tree.tree.subscribe(0, 1, capacity=0)  # stalls the put on key 0 until closed
+    writer = threading.Thread(target=tree.put, args=(0, "stalled"))
+    writer.start()
+    while not tree.inflight:
+        time.sleep(0.001)
+    tree.put(nkeys, "new")
+    seen = tree.get(nkeys)
+    sub.close()
+    writer.join()
+    assert seen == "new", "mvcc get missed a returned put: %s" % (seen,)
+
+    # even keys stay present, the scanning thread puts and removes odd keys while it walks,
+    # so rotations and unlinks hit the walk between chunks
+    tree = ConAVL()
+    evens = list(range(0, 32 * nkeys, 2))
+    for key in evens:
+        tree.put(key, key)
+    for i in range(3):
+        keys = []
+        for key, val in tree.scan(chunk=16):
+            if key % 2 == 0:
+                keys.append(key)
+            for j in range(2):
+                odd = rnd.randrange(32 * nkeys) | 1
+                if rnd.random() < 0.5:
+                    tree.put(odd, odd)
+                else:
+                    tree.remove(odd)
+        assert keys == evens, "scan missed or repeated %d keys" % abs(len(evens) - len(keys))
+
+def feedTest(nthreads=4, nops=2000, nkeys=64, seed=0):
+    """
+    Checks the ConAVL change feed: a consumer that applies the events of a subscription to a dict
+    ends with the contents of the subscribed range while writers run concurrently, and a full
+    subscription only holds back the writes to its own range. Raises AssertionError on a violation.
+    """
+    tree = ConAVL()
+    lo, hi = nkeys // 4, 3 * nkeys // 4
+    sub = tree.subscribe(lo, hi, capacity=32)
+    mirror = {}
+    outside = []
+    def consume():
+        for key, val in sub:
+            if not lo <= key < hi:
+                outside.append(key)
+            elif val is None:
+                mirror.pop(key, None)
+            else:
+                mirror[key] = val
+    def worker(tid):
+        rnd = random.Random(seed * 1000 + tid)
+        for i in range(nops // nthreads):
+            key = rnd.randrange(nkeys)
+            r = rnd.random()
+            if r < 0.4:
+                tree.put(key, "%d.%d" % (tid, i))
+            elif r < 0.7:
+                tree.remove(key)
+            elif r < 0.9:
+                tree.compute(key, lambda val: None if val is None else val + "+")
+            else:
+                tree.transaction([(TXN_P, key, "%d.%d" % (tid, i)), (TXN_R, rnd.randrange(nkeys))])
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(nthreads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    sub.close()
+    consumer.join()
+    assert not outside, "feed reported keys out of range: %s" % (outside[:5],)
+    assert mirror == dict(tree.range(lo, hi)), "feed mirror differs from the tree"
+
+    # nothing drains sub: writes inside [lo, hi) wait once it is full, writes outside go on
+    sub = tree.subscribe(lo, hi, capacity=2)
+    blocked = threading.Thread(target=lambda: [tree.put(key) for key in range(lo, hi)])
+    blocked.start()
+    blocked.join(0.05)
+    assert blocked.is_alive(), "feed did not throttle writes past its capacity"
+    writer = threading.Thread(target=lambda: [tree.put(key) for key in list(range(lo)) + list(range(hi, nkeys))])
+    writer.start()
+    writer.join(5.0)
+    outsideDone = not writer.is_alive()
+    sub.close()
+    blocked.join()
+    writer.join()
+    assert outsideDone, "feed throttled writes outside the subscribed range"
+
+def storeTest(nops=2000, nkeys=64, seed=0):
+    """
+    Checks ConAVL with an Arena and a KeySet store against a dict, through every write operation:
+    reads return the stored bytes (PRESENT for a KeySet), and the live bytes of the Arena are
+    exactly the bytes of the values in the tree, so no write releases a value it kept or keeps
+    a value it replaced. Arena stats add up, and a copy into a new Arena drops the dead bytes.
+    Raises AssertionError on a violation.
+    """
+    for store in (Arena(chunk_size=256), KeySet()):
+        rnd = random.Random(seed)
+        tree = ConAVL(store=store)
+        model = {}
+        def read(val):
+            return None if val is None else PRESENT if store.__class__ is KeySet else bytes(val)
+        for i in range(nops):
+            key = rnd.randrange(nkeys)
+            val = b"%d" % i * rnd.randrange(1, 4)
+            r = rnd.random()
+            if r < 0.25:
+                tree.put(key, val)
+                model[key] = val
+            elif r < 0.35:
+                tree.put(key)
+                model[key] = str(key).encode()
+            elif r < 0.45:
+                tree.remove(key)
+                model.pop(key, None)
+            elif r < 0.5:
+                if tree.put_if_absent(key, val) is None:
+                    model[key] = val
+            elif r < 0.6:
+                expected = model.get(key, b"")
+                if tree.replace(key, expected, val):
+                    model[key] = val
+            elif r < 0.65:
+                if tree.remove_if(key, model.get(key, b"")):
+                    del model[key]
+            elif r < 0.75:
+                # returning the value it was given leaves the key as it is
+                tree.compute(key, lambda old: old)
+            elif r < 0.8:
+                tree.compute(key, lambda old: None if old is None else val)
+                if key in model:
+                    model[key] = val
+            elif r < 0.85:
+                popped = tree.pop_min()
+                assert (popped is None) == (not model), "store pop_min on %d keys returned %s" % (len(model), popped)
+                if popped is not None:
+                    assert popped[0] == min(model) and read(popped[1]) == read(model.pop(popped[0])), "store pop_min"
+            elif r < 0.9:
+                other = rnd.randrange(nkeys)
+                try:
+                    # the unknown operation rolls the transaction back
+                    tree.transaction([(TXN_P, key, val), (TXN_R, other), (TXN_G, key), (-1, key)] if r < 0.87 else
+                                     [(TXN_P, key, val), (TXN_R, other), (TXN_G, key)])
+                except ValueError:
+                    pass
+                else:
+                    model[key] = val
+                    model.pop(other, None)
+            else:
+                assert read(tree.get(key)) == read(model.get(key)), "store key %s: got %s, expected %s" % (key, read(tree.get(key)), read(model.get(key)))
+            if store.__class__ is Arena:
+                assert store.live() == sum(len(val) for val in model.values()), "arena live %d bytes, tree holds %d" % (
+                    store.live(), sum(len(val) for val in model.values()))
+        assert [(key, read(val)) for key, val in tree.range()] == sorted((key, read(val)) for key, val in model.items()), "store range"
+        if store.__class__ is Arena:
+            # released space is never reused, copying the items into a new Arena reclaims it
+            stats = store.stats()
+            assert stats["live"] == store.live() and stats["live"] + stats["dead"] == stats["used"] <= stats["allocated"], "arena stats %s" % (stats,)
+            copy = ConAVL(store=Arena(chunk_size=256))
+            for key, val in tree.range():
+                copy.put(key, bytes(val))
+            fresh = copy.store.stats()
+            assert fresh["live"] == stats["live"] and fresh["dead"] == 0 and fresh["allocated"] < stats["live"] + 256, "arena copy stats %s" % (fresh,)
+
+def cowTest(nops=2000, nkeys=64, seed=0):
+    """
+    Checks CowAVL against a dict: every write returns the previous value, reads and the final
+    shape are exact, and a snapshot keeps its contents while the tree changes. Then checks that
+    readers racing with a writer only see complete versions. Raises AssertionError on a violation.
+    """
+    rnd = random.Random(seed)
+    tree = CowAVL()
+    model = {}
+    snapshots = []  # (snapshot, sorted items when taken)
+    for i in range(nops):
+        key = rnd.randrange(nkeys)
+        r = rnd.random()
+        if r < 0.45:
+            assert tree.put(key, i) == model.get(key), "cow put %s: wrong previous value" % (key,)
+            model[key] = i
+        elif r < 0.8:
+            assert tree.remove(key) == model.pop(key, None), "cow remove %s: wrong previous value" % (key,)
+        elif r < 0.95:
+            assert tree.get(key) == model.get(key), "cow key %s: got %s, expected %s" % (key, tree.get(key), model.get(key))
+        else:
+            snapshots.append((tree.snapshot(), sorted(model.items())))
+    items = sorted(model.items())
+    assert tree.range() == items and len(tree) == len(model), "cow range differs from the model"
+    assert tree.range(nkeys // 4, nkeys // 2) == [(key, val) for key, val in items if nkeys // 4 <= key < nkeys // 2], "cow bounded range"
+    assert tree.min() == (items[0][0] if items else None) and tree.max() == (items[-1][0] if items else None), "cow min/max"
+    for snapshot, taken in snapshots:
+        assert snapshot.range() == taken, "cow snapshot changed"
+    errors = checkInvariants(tree)
+    assert not errors, "\n".join(errors)
+
+    # the writer inserts ascending keys, so every version holds the keys 0..n-1
+    tree = CowAVL()
+    torn = []
+    stop = []
+    def reader():
+        while not stop:
+            keys = [key for key, val in tree.range()]
+            if keys != list(range(len(keys))):
+                torn.append(len(keys))
+    readers = [threading.Thread(target=reader) for i in range(2)]
+    for t in readers:
+        t.start()
+    for key in range(nops):
+        tree.put(key)
+    stop.append(True)
+    for t in readers:
+        t.join()
+    assert not torn, "cow readers saw %d incomplete versions" % len(torn)
+
+def frozenTest(nops=2000, nkeys=64, seed=0):
+    """
+    Checks FrozenAVL indexes frozen from an AVL and a ConAVL against a dict: get, membership, range,
+    count, rank, select and min/max of every index match the model at the time it was built.
+    Odd seeds use keys beyond int64, which the index keeps in a list instead of an array('q').
+    Raises AssertionError on a violation.
+    """
+    rnd = random.Random(seed)
+    base = 1 << 64 if seed % 2 else 0
+    trees = [AVL(), ConAVL()]
+    model = {}
+    for i in range(nops):
+        key = base + rnd.randrange(nkeys)
+        r = rnd.random()
+        if r < 0.55:
+            for tree in trees:
+                tree.put(key, i)
+            model[key] = i
+        elif r < 0.9:
+            if key in model:
+                # AVL.remove prints a warning for a missing key
+                for tree in trees:
+                    tree.remove(key)
+                del model[key]
+        else:
+            items = sorted(model.items())
+            keys = [key for key, val in items]
+            lo = base + rnd.randrange(nkeys)
+            hi = lo + rnd.randrange(nkeys // 2)
+            for tree in trees:
+                name = type(tree).__name__
+                frozen = FrozenAVL(tree)
+                assert frozen.range() == items and len(frozen) == len(items), "frozen %s: range differs from the model" % name
+                assert frozen.range(lo, hi) == [(k, v) for k, v in items if lo <= k < hi], "frozen %s: bounded range" % name
+                assert frozen.count(lo, hi) == len([k for k in keys if lo <= k < hi]), "frozen %s: count" % name
+                assert frozen.get(lo) == model.get(lo) and (lo in frozen) == (lo in model), "frozen %s key %s: get" % (name, lo)
+                assert frozen.rank(lo) == len([k for k in keys if k < lo]), "frozen %s key %s: rank" % (name, lo)
+                if items:
+                    j = rnd.randrange(len(items))
+                    assert frozen.select(j) == items[j], "frozen %s: select %d" % (name, j)
+                assert frozen.min() == (keys[0] if keys else None) and frozen.max() == (keys[-1] if keys else None), "frozen %s: min/max" % name
+                assert frozen.peek_min() == (items[0] if items else None) and frozen.peek_max() == (items[-1] if items else None), "frozen %s: peek_min/peek_max" % name
+
+def avlTest(nops=2000, nkeys=64, seed=0):
+    """
+    Checks AVL removal against a dict: removing a missing key leaves the tree unchanged (it used to
+    remove the would-be parent), removing a root with two children keeps both subtrees (it used to
+    lose the right one), and the tree keeps its contents and strict invariants after every write.
+    Raises AssertionError on a violation.
+    """
+    rnd = random.Random(seed)
+    tree = AVL()
+    model = {}
+    for i in range(nops):
+        key = rnd.randrange(nkeys)
+        if rnd.random() < 0.5:
+            tree.put(key, i)
+            model[key] = i
+        elif key in model:
+            tree.remove(key)
+            del model[key]
+        else:
+            # AVL.remove prints a warning for a missing key
+            stdout, sys.stdout = sys.stdout, io.StringIO()
+            try:
+                tree.remove(key)
+            finally:
+                sys.stdout = stdout
+        if model and rnd.random() < 0.05:
+            if tree.root.left is not None and tree.root.right is not None:
+                key = tree.root.key
+                tree.remove(key)
+                del model[key]
+        assert tree.range() == sorted(model.items()), "avl contents differ from the model after %d ops" % (i + 1,)
+        errors = checkInvariants(tree)
+        assert not errors, "\n".join(errors)
+
+def shapeTest(nkeys=600, seed=0, samples=256):
+    """
+    Checks pyShape on AVL and ConAVL trees after random inserts and removals: the estimated key count
+    is within 30% of the real one and the sampled max depth never exceeds the height. Then checks that
+    a ShapeMonitor rebuilds a degenerate deferred ConAVL once and leaves the rebuilt tree alone.
+    Raises AssertionError on a violation.
+    """
+    def height(dnode):
+        return 0 if dnode is None else 1 + max(height(dnode.left), height(dnode.right))
+    rnd = random.Random(seed)
+    for tree in (AVL(), ConAVL()):
+        name = type(tree).__name__
+        keys = rnd.sample(range(nkeys * 50), nkeys)
+        for key in keys:
+            tree.put(key)
+        for key in keys[:nkeys // 4]:
+            tree.remove(key)
+        live = nkeys - nkeys // 4
+        stats = shapeStats(tree, samples, rnd)
+        assert abs(stats.keys - live) <= 0.3 * live, "%s shape: estimated %.0f keys, expected %d" % (name, stats.keys, live)
+        depth = height(tree.root.right if isinstance(tree, ConAVL) else tree.root)
+        assert stats.maxDepth <= depth, "%s shape: sampled depth %d > height %d" % (name, stats.maxDepth, depth)
+
+    # without repairs, ascending inserts make a deferred tree a list
+    tree = ConAVL(deferred=True, defer_limit=nkeys, defer_depth=nkeys + 1)
+    for key in range(nkeys):
+        tree.put(key)
+    monitor = ShapeMonitor(tree, depthPolicy(min_keys=64), samples=samples)
+    stats = monitor.check()
+    assert stats.maxDepth == nkeys and monitor.rebuilds == 1, "shape monitor did not rebuild a list"
+    stats = monitor.check()
+    assert stats.ratio <= 1.5 and monitor.rebuilds == 1, "shape monitor rebuilt a balanced tree"
+    assert tree.range() == [(key, str(key)) for key in range(nkeys)], "shape rebuild changed the contents"
+    errors = checkInvariants(tree)
+    assert not errors, "\n".join(errors)
+
+def mmapTest(nops=2000, nkeys=64, seed=0):
+    """
+    Checks MmapAVL against a dict with a small record cache, so that records are written back and
+    decoded again: get, range and len match the model, closing and reopening the file keeps the tree,
+    a put that cannot be packed raises before anything changes, and build() writes a tree that reads
+    back the same. Raises AssertionError on a violation.
+    """
+    rnd = random.Random(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "tree")
+        tree = MmapAVL(path, cache_size=8, capacity=4)
+        model = {}
+        for i in range(nops):
+            key = rnd.randrange(-nkeys, nkeys)
+            r = rnd.random()
+            if r < 0.45:
+                tree.put(key, i)
+                model[key] = i
+            elif r < 0.7:
+                tree.remove(key)
+                model.pop(key, None)
+            elif r < 0.9:
+                assert tree.get(key) == model.get(key), "mmap key %s: got %s, expected %s" % (key, tree.get(key), model.get(key))
+            elif r < 0.95:
+                for bad in ((key, "a"), ("a", i), (key, 1 << 63), (-(1 << 63) - 1, i)):
+                    try:
+                        tree.put(*bad)
+                    except (TypeError, OverflowError):
+                        pass
+                    else:
+                        raise AssertionError("mmap put%r did not raise" % (bad,))
+            else:
+                tree.close()
+                tree = MmapAVL(path, cache_size=8)
+            if i % 100 == 0:
+                assert tree.range() == sorted(model.items()) and len(tree) == len(model), "mmap range differs from the model"
+        lo = rnd.randrange(-nkeys, nkeys)
+        assert tree.range(lo, lo + nkeys // 2) == [(key, val) for key, val in sorted(model.items()) if lo <= key < lo + nkeys // 2], "mmap bounded range"
+        tree.close()
+        with MmapAVL(path) as tree:
+            assert tree.range() == sorted(model.items()), "mmap tree changed across close and reopen"
+
+        keys = sorted(rnd.sample(range(-nkeys * 10, nkeys * 10), nkeys))
+        MmapAVL.build(path, keys, [2 * key for key in keys]).close()
+        with MmapAVL(path) as tree:
+            assert tree.range() == [(key, 2 * key) for key in keys], "mmap build differs from its keys"
+            tree.put(nkeys * 20)
+            assert tree.get(nkeys * 20) == nkeys * 20 and len(tree) == nkeys + 1, "mmap put after build"
+
+def kvTest(nops=2000, nkeys=64, seed=0, depth=32):
+    """
+    Checks KVServer and KVClient against a dict over a Unix socket. Requests are pipelined up to depth
+    in flight and answered in order, so every reply must match the model at the time it was sent; runs
+    of gets are long enough for the batched get_array path. Then checks that failed requests leave the
+    pipeline in step: a put that cannot be packed raises at once, a cancelled request's reply is
+    dropped, and an unknown operation fails only its own future. Raises AssertionError on a violation.
+    """
+    async def run(path):
+        server = asyncio.ensure_future(KVServer().serve(path))
+        while not os.path.exists(path):
+            await asyncio.sleep(0.001)
+        client = await KVClient.connect(path)
+        rnd = random.Random(seed)
+        model = {}
+        window = []  # (future, expected result)
+        for i in range(nops):
+            key = rnd.randrange(nkeys)
+            r = rnd.random()
+            if r < 0.3:
+                val = b"%d" % i
+                window.append((client.put(key, val), None))
+                model[key] = val
+            elif r < 0.4:
+                window.append((client.remove(key), None))
+                model.pop(key, None)
+            elif r < 0.95:
+                for j in range(rnd.choice((1, 1, GET_BATCH + 4))):
+                    key = rnd.randrange(nkeys)
+                    window.append((client.get(key), model.get(key)))
+            else:
+                lo = rnd.randrange(nkeys)
+                window.append((client.range(lo, lo + nkeys // 4), [(k, v) for k, v in sorted(model.items()) if lo <= k < lo + nkeys // 4]))
+            if len(window) >= depth:
+                for future, expected in window:
+                    assert await future == expected, "kv request %d: got %r, expected %r" % (i, future.result(), expected)
+                window = []
+        for future, expected in window:
+            assert await future == expected, "kv: got %r, expected %r" % (future.result(), expected)
+
+        try:
+            client.put(0, "not bytes")
+        except TypeError:
+            pass
+        else:
+            raise AssertionError("kv put of a str did not raise")
+        cancelled = client.get(0)
+        cancelled.cancel()
+        # 255 is no operation code, the client has no public call for it
+        rejected = client._KVClient__send(255, 0, b"")
+        put = client.put(1, b"one")
+        get = client.get(1)
+        try:
+            await rejected
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("kv unknown op did not fail")
+        assert await put is None and await get == b"one", "kv pipeline out of step after failed requests"
+
+        other = await KVClient.connect(path)
+        model[1] = b"one"
+        assert await other.range(-1, nkeys) == sorted(model.items()), "kv second connection sees other contents"
+        await other.close()
+        await client.close()
+        server.cancel()
+        try:
+            await server
+        except asyncio.CancelledError:
+            pass
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(os.path.join(directory, "kv.sock")))
+
+def profileTest(nthreads=4, nops=500, nkeys=64, seed=0):
+    """
+    Checks a ConAVL under LockProfiler: the tree still matches a dict after single-key writes and
+    transactions, only node locks are wrapped (a stripe lock taken by a transaction or a plain write
+    would show up as a site ending in transaction or writeNode), every acquisition is released and
+    recorded once in each table, rotations are appended to the site of the locks they ran under, and
+    the folded export parses. Then checks the counts again with threads. Raises AssertionError on a violation.
+    """
+    rnd = random.Random(seed)
+    profiler = LockProfiler()
+    tree = ConAVL(profiler=profiler)
+    assert isinstance(tree.root.lock, ProfiledLock), "profiler did not wrap the node locks"
+    assert not any(isinstance(lock, ProfiledLock) for lock in tree.txnLocks + [tree.txnGate]), "profiler wrapped the stripe locks"
+    model = {}
+    for i in range(nops * nthreads):
+        key = rnd.randrange(nkeys)
+        r = rnd.random()
+        if r < 0.5:
+            tree.put(key, i)
+            model[key] = i
+        elif r < 0.8:
+            tree.remove(key)
+            model.pop(key, None)
+        else:
+            other = rnd.randrange(nkeys)
+            tree.transaction([(TXN_P, key, i), (TXN_R, other)])
+            model[key] = i
+            model.pop(other, None)
+    assert tree.range() == sorted(model.items()), "profiled tree differs from the model"
+    errors = checkInvariants(tree)
+    assert not errors, "\n".join(errors)
+
+    def check(name):
+        hold = profiler.report("hold")
+        wait = profiler.report("wait")
+        assert hold and profiler.held() == [], "%s: no hold times, or locks still held" % name
+        assert sum(r[1] for r in hold) == sum(r[1] for r in wait), "%s: acquisitions and releases differ" % name
+        for site, count, total, p50, p99, most in hold + wait:
+            assert site.split(";")[-1] not in ("transaction", "writeNode"), "%s: stripe lock profiled at %s" % (name, site)
+            assert count > 0 and p50 <= p99 and most <= total, "%s: bad histogram at %s" % (name, site)
+        assert any(site.rsplit(";", 1)[-1] in TAGGED_OPS for site, *rest in hold), "%s: no rotation tagged" % name
+        for line in profiler.folded("hold").splitlines():
+            site, micros = line.rsplit(" ", 1)
+            assert site and int(micros) >= 1, "%s: bad folded line %r" % (name, line)
+    check("profile")
+
+    profiler.reset()
+    assert profiler.report() == [] and profiler.report("wait") == [], "profiler reset kept samples"
+    def worker(tid):
+        wrnd = random.Random(seed * 1000 + tid)
+        for i in range(nops):
+            key = wrnd.randrange(nkeys * 4)
+            if wrnd.random() < 0.6:
+                tree.put(key, i)
+            else:
+                tree.remove(key)
+    tpool = [threading.Thread(target=worker, args=(i,)) for i in range(nthreads)]
+    for t in tpool:
+        t.start()
+    for t in tpool:
+        t.join()
+    check("threaded profile")
+    errors = checkInvariants(tree)
+    assert not errors, "\n".join(errors)
+
+def joinTest(nrounds=40, nkeys=128, seed=0):
+    """
+    Checks split, join and union of AVL, ConAVL and deferred ConAVL trees against sorted lists:
+    both halves of a split and the joined tree keep their keys and strict invariants, the new trees
+    keep the options of the tree they came from and take writes, join refuses overlapping trees, and
+    union lets the values of its argument win. Raises AssertionError on a violation.
+    """
+    rnd = random.Random(seed)
+    for make in (AVL, ConAVL, lambda: ConAVL(deferred=True)):
+        tree = make()
+        name = type(tree).__name__
+        model = {}
+        for i in range(nrounds):
+            for key in rnd.sample(range(nkeys), nkeys // 8):
+                tree.put(key, i)
+                model[key] = i
+            key = rnd.randrange(nkeys)
+            right = tree.split(key)
+            items = sorted(model.items())
+            assert tree.range() == [item for item in items if item[0] < key], "%s split: left keys" % name
+            assert right.range() == [item for item in items if item[0] >= key], "%s split: right keys" % name
+            assert type(right) is type(tree), "%s split: wrong tree type" % name
+            for half in (tree, right):
+                if isinstance(half, ConAVL):
+                    assert (half.damaged is None) == (tree.damaged is None), "%s split: deferred mode lost" % name
+                    half.rebalance()
+                errors = checkInvariants(half)
+                assert not errors, "\n".join(errors)
+            if model and rnd.random() < 0.5:
+                # a new key on each side still lands in the right half
+                low, high = rnd.randrange(key) if key else None, rnd.randrange(key, nkeys)
+                if low is not None:
+                    tree.put(low, -1)
+                    model[low] = -1
+                right.put(high, -1)
+                model[high] = -1
+            if tree.range() and right.range():
+                try:
+                    right.join(tree)
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError("%s join accepted overlapping trees" % name)
+            tree.join(right)
+            assert tree.range() == sorted(model.items()) and right.range() == [], "%s join: keys" % name
+            if isinstance(tree, ConAVL):
+                tree.rebalance()
+            errors = checkInvariants(tree)
+            assert not errors, "\n".join(errors)
+        other = make()
+        for key in rnd.sample(range(nkeys), nkeys // 2):
+            other.put(key, "other")
+        union = tree.union(other)
+        expected = dict(model)
+        expected.update((key, val) for key, val in other.range())
+        assert union.range() == sorted(expected.items()), "%s union: keys" % name
+        errors = checkInvariants(union)
+        assert not errors, "\n".join(errors)
+
+if __name__ == "__main__":
+    # usage: python pyAVLCheck.py [rounds] [min_ops_per_sec]
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    gate = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    for seed in range(rounds):
+        report = stressTest(seed=seed, min_ops_per_sec=gate)
+        print("seed %d: %d ops, %.0f ops/s" % (seed, report["ops"], report["ops_per_sec"]))
+    for seed in range(rounds):
+        # deterministic interleavings, with a key range wide enough for rotations around routing nodes
+        scheduler = Scheduler(seed=seed)
+        stressTest(seed=seed, tree=ConAVL(scheduler=scheduler), scheduler=scheduler, nkeys=200)
+        print("scheduled seed %d: ok" % seed)
+    for seed in range(rounds):
+        # deferred repair: small limits so that writers also rebalance, next to a maintenance thread
+        tree = ConAVL(deferred=True, defer_limit=8, defer_depth=6)
+        tree.start_maintenance(interval=0.001)
+        stressTest(seed=seed, tree=tree, nkeys=200)
+        scheduler = Scheduler(seed=seed)
+        stressTest(seed=seed, tree=ConAVL(scheduler=scheduler, deferred=True, defer_limit=8, defer_depth=6), scheduler=scheduler, nkeys=200)
+        print("deferred seed %d: ok" % seed)
+    for seed in range(rounds):
+        # single-threaded model checks of the trees built on ConAVL
+        ttlTest(seed=seed, deferred=seed % 2 == 1)
+        mvccTest(seed=seed)
+        feedTest(seed=seed)
+        storeTest(seed=seed)
+        cowTest(seed=seed)
+        frozenTest(seed=seed)
+        avlTest(seed=seed)
+        shapeTest(seed=seed)
+        mmapTest(seed=seed)
+        kvTest(seed=seed)
+        profileTest(seed=seed)
+        joinTest(seed=seed)
+        print("model seed %d: ok" % seed)
@@ -0,0 +1,17 @@
+# numpy helpers shared by the array exports of AVL and ConAVL
+# numpy is optional: the trees import this module either way, only the array methods need it.
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def keyDtype(keys):
+    """
+    Returns the numpy dtype of an array of keys: int64 if every key fits in one, object otherwise.
+    Without it numpy makes the keys of an empty range float64.
+    """
+    for key in keys:
+        if isinstance(key, bool) or not isinstance(key, (int, np.integer)) or not -2**63 <= key < 2**63:
+            return object
+    return np.int64
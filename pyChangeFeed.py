@@ -0,0 +1,120 @@
+# Change feed subscriptions for ConAVL
+# Writers append (key, value) events to the queue of every subscription whose range holds the key, at the
+# point where the write commits under the node lock, so the events of a key arrive in commit order.
+# A removal is reported with value None. Consumers drain the queue in batches and coalesce the events of
+# a key into the latest one. Writers only wait for a consumer after releasing their locks, when its
+# queue is over capacity.
+
+import asyncio
+import threading
+from collections import deque
+
+class Subscription(object):
+
+    def __init__(self, tree, lo=None, hi=None, capacity=1024):
+        """
+        Receives the put and remove events of tree with lo <= key < hi (None means unbounded).
+        Writers block once more than capacity events are waiting to be consumed.
+        """
+        self.tree = tree
+        self.lo = lo
+        self.hi = hi
+        self.capacity = capacity
+        self.queue = deque()  # appended by writers without a lock, drained by the consumer
+        self.ready = threading.Event()  # set when the queue may be non-empty
+        self.drained = threading.Event()  # set when the consumer drained the queue
+        self.waiter = None  # future of an async consumer waiting for events
+        self.batch = deque()  # coalesced events not handed out yet
+        self.closed = False
+
+    def matches(self, key):
+        return (self.lo is None or key >= self.lo) and (self.hi is None or key < self.hi)
+
+    def push(self, key, val):
+        """
+        Called by a writer holding the node lock of key: must not block.
+        """
+        self.queue.append((key, val))
+        if not self.ready.is_set():
+            self.ready.set()
+            waiter = self.waiter
+            if waiter is not None:
+                self.waiter = None
+                waiter.get_loop().call_soon_threadsafe(self.__wake, waiter)
+
+    def throttle(self):
+        """
+        Called by a writer after releasing its locks: waits while the queue is over capacity.
+        """
+        while len(self.queue) > self.capacity and not self.closed:
+            self.drained.clear()
+            if len(self.queue) <= self.capacity:
+                return
+            # the timeout covers a drain that happened between the check and the clear
+            self.drained.wait(0.01)
+
+    def poll(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for events, and returns the pending events
+        as a list of (key, value) pairs, with only the latest event of each key, in the order of
+        the latest events.
+        """
+        if not self.queue and not self.closed:
+            self.ready.wait(timeout)
+        self.ready.clear()
+        latest = {}
+        for i in range(len(self.queue)):
+            key, val = self.queue.popleft()
+            latest.pop(key, None)
+            latest[key] = val
+        self.drained.set()
+        return list(latest.items())
+
+    def close(self):
+        """
+        Stops the subscription, the iterators end once the pending events are consumed.
+        """
+        self.closed = True
+        self.tree.unsubscribe(self)
+        self.ready.set()
+        self.drained.set()
+        waiter = self.waiter
+        if waiter is not None:
+            self.waiter = None
+            waiter.get_loop().call_soon_threadsafe(self.__wake, waiter)
+
+    def __iter__(self):
+        """
+        Generator of the coalesced events, blocks while there are none.
+        """
+        while True:
+            events = self.poll()
+            if not events and self.closed and not self.queue:
+                return
+            for event in events:
+                yield event
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.batch:
+            self.batch.extend(self.poll(0))
+            if self.batch:
+                break
+            if self.closed:
+                raise StopAsyncIteration
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiter = waiter
+            # a writer that finds ready cleared wakes the waiter
+            self.ready.clear()
+            if self.queue or self.closed:
+                # raced with a writer that did not see the waiter
+                self.waiter = None
+                continue
+            await waiter
+        return self.batch.popleft()
+
+    def __wake(self, waiter):
+        if not waiter.done():
+            waiter.set_result(None)
@@ -4,8 +4,20 @@
 
 from graphviz import Digraph
 from IPython.display import Image, display
-import threading
+from bisect import bisect_left, bisect_right
+from collections import deque
+from pySched import Scheduler
+from pyArrays import keyDtype
+from pyChangeFeed import Subscription
+from pyJoin import joinNodes
+from pyPeriodic import PeriodicTask
 import random
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Node condition codes
 
@@ -13,6 +25,30 @@ UNLINK = -1
 REBALANCE = -2
 NOTHING = -3
 
+# Node version flags, the rest of the version is the number of completed shrinks
+# Versions are ints that are replaced, never mutated, so a read of node.version is a snapshot
+
+UNLINKED = 1
+SHRINKING = 2
+
+# Transaction operation codes
+
+TXN_G = 0 # get (TXN_G, KEY)
+TXN_P = 1 # put (TXN_P, KEY, VAL)
+TXN_R = 2 # remove (TXN_R, KEY)
+
+# Number of key lock stripes used by transactions
+TXN_STRIPES = 64
+
+def nextVersion(version):
+    """
+    Returns the version to publish once a rotation is completed: the next number, flags cleared.
+    """
+    return (version | SHRINKING | UNLINKED) + 1
+
+def nodeHeight(node):
+    return 0 if node is None else node.height
+
 class CC_RETRY(object):
     """
     Concurrent Control RETRY type:
@@ -23,18 +59,60 @@ class CC_RETRY(object):
 
 class ConAVL(object):
 
-    def __init__(self, simulate=False):
+    def __init__(self, simulate=False, scheduler=None, deferred=False, defer_limit=64, defer_depth=48, profiler=None, store=None):
         """
         Initializes the ConAVL object. The root is set as an empty node. root.right will point to the actual root.
+        scheduler is a pySched.Scheduler that controls the thread interleaving at the named yield points,
+        simulate=True uses a scheduler that randomly preempts free-running threads instead.
+        With deferred=True writers only queue the nodes they damaged, and the heights and rotations are
+        repaired in bulk by rebalance() or a maintenance thread. A writer that finds more than defer_limit
+        queued nodes runs rebalance() itself, which bounds the queue length but not the depth: a run of
+        inserts at one end of the key range deepens a path by one level per insert whichever nodes are queued.
+        A writer that inserts deeper than defer_depth also runs rebalance(), which bounds the depth
+        (a balanced tree of 2**32 keys is at most 46 levels deep).
+        profiler is a pyLockProfile.LockProfiler that records node lock hold and wait times.
+        store is a pyValueStore store that keeps the values outside the nodes (Arena), or no values at all (KeySet).
         """
-        self.root = Node(None)
+        if scheduler is None and simulate:
+            scheduler = Scheduler(preempt=0.5)
         self.simulate = simulate
+        self.scheduler = scheduler
+        self.newLock = threading.Lock if scheduler is None else scheduler.Lock
+        # the stripe locks come from the raw factory, before a profiler wraps it for the node locks
+        self.txnLocks = [self.newLock() for i in range(TXN_STRIPES)]
+        # transactions running and transactions started, read by get() without the lock
+        self.txnGate = self.newLock()
+        self.txnActive = 0
+        self.txnStarted = 0
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.attach(self)
+        self.root = Node(None, lock=self.newLock())
+        self.damaged = deque() if deferred else None
+        self.deferLimit = defer_limit
+        self.deferDepth = defer_depth
+        self.maintenance = None
+        # cached [min, max] data nodes, see __extremeNode
+        self.extremaLock = threading.Lock()
+        self.extrema = [None, None]
+        self.extremaEpoch = [0, 0]
+        self.extremaRefreshing = [0, 0]
+        # change feed, replaced as a whole under feedLock so writers iterate it without a lock
+        self.feedLock = threading.Lock()
+        self.subscriptions = ()
+        self.store = store
 
     def get(self, key):
         """
         Returns the value of the node with corresponding key.
         """
-        return self.__getNode(self.root, key)
+        started = self.txnStarted
+        val = self.__getNode(self.root, key)
+        if self.txnActive or self.txnStarted != started:
+            # a transaction ran during the read, which may have seen one of its writes before the commit
+            with self.txnLocks[hash(key) % TXN_STRIPES]:
+                val = self.__getNode(self.root, key)
+        return val if self.store is None or val is None else self.store.decode(val)
 
     def put(self, key, val = None):
         """
@@ -43,13 +121,369 @@ class ConAVL(object):
         When key and value are sent and key is unique, it creates a new node with given key and given value
         When key and value are sent and key is already present, it updates the node with given key to the given value
         """
-        self.__putNode(key, str(key) if val is None else val, self.root)
+        self.__release(self.__writeNode(key, self.__encode(key, val)))
 
     def remove(self, dkey):
         """
         Removes the node with given key. The actual node might not be deleted from the tree. (see reference paper)
         """
-        self.__putNode(dkey, None, self.root)
+        self.__release(self.__writeNode(dkey, None))
+
+    def put_if_absent(self, key, val = None):
+        """
+        Inserts the node only if key is not present.
+        Returns the current value if key is present, otherwise None.
+        """
+        ref = self.__encode(key, val)
+        prev = self.__writeNode(key, None, lambda prev: ref if prev is None else prev)
+        if prev is not None:
+            self.__release(ref)
+        return self.__decode(prev)
+
+    def replace(self, key, expected, val):
+        """
+        Updates the value of key to val only if its current value equals expected.
+        Returns True if the value was replaced.
+        """
+        ref = self.__encode(key, val)
+        prev = self.__writeNode(key, None, lambda prev: ref if prev is not None and self.__decode(prev) == expected else prev)
+        replaced = prev is not None and self.__decode(prev) == expected
+        self.__release(prev if replaced else ref)
+        return replaced
+
+    def compute(self, key, fn):
+        """
+        Atomically replaces the value of key with fn(prev), where prev is None if key is not present.
+        Returning None from fn removes the key. Returns the new value.
+        """
+        result = [None, False]  # new value, stored ref replaced by the last call of update
+        def update(prev):
+            if self.store is None:
+                result[0] = fn(prev)
+                return result[0]
+            old = self.__decode(prev)
+            result[0] = fn(old)
+            # decode may build a new object per call (Arena views), so only this identity check is valid
+            result[1] = result[0] is not old
+            if not result[1]:
+                return prev
+            return None if result[0] is None else self.store.encode(key, result[0])
+        prev = self.__writeNode(key, None, update)
+        if prev is not None and result[1]:
+            self.store.release(prev)
+        return result[0]
+
+    def remove_if(self, key, expected):
+        """
+        Removes the node with given key only if its current value equals expected.
+        Returns True if the node was removed.
+        """
+        prev = self.__writeNode(key, None, lambda prev: None if prev is not None and self.__decode(prev) == expected else prev)
+        removed = prev is not None and self.__decode(prev) == expected
+        if removed:
+            self.__release(prev)
+        return removed
+
+    def transaction(self, seq):
+        """
+        Runs an operation sequence atomically and isolated from other transactions and single-key operations.
+        seq is a list of tuples (TXN_G, key), (TXN_P, key, val) or (TXN_R, key).
+        The key stripes touched by seq are locked in a global order (two-phase locking),
+        so concurrent transactions cannot deadlock. Writes outside transactions hold their key's stripe
+        while a transaction is active, and get() reads again under it when a transaction ran meanwhile.
+        A single-key write that checked just before the transaction started is not held back: it lands
+        where it lands, and the rollback keeps it. range and the other scans are not isolated. If an
+        operation raises, the writes already applied are rolled back. Returns the list of results,
+        where put and remove return the previous value.
+        """
+        stripes = sorted(set(hash(p[1]) % TXN_STRIPES for p in seq))
+        with self.txnGate:
+            self.txnActive += 1
+            self.txnStarted += 1
+        for i in stripes:
+            self.txnLocks[i].acquire()
+        try:
+            results = []
+            undo = []
+            try:
+                for p in seq:
+                    if p[0] == TXN_G:
+                        results.append(self.__decode(self.__getNode(self.root, p[1])))
+                    elif p[0] == TXN_P:
+                        ref = self.__encode(p[1], p[2])
+                        prev = self.__putNode(p[1], ref, self.root)
+                        undo.append((p[1], prev, ref))
+                        results.append(self.__decode(prev))
+                    elif p[0] == TXN_R:
+                        prev = self.__putNode(p[1], None, self.root)
+                        undo.append((p[1], prev, None))
+                        results.append(self.__decode(prev))
+                    else:
+                        raise ValueError("unknown transaction operation: %s" % (p[0],))
+            except BaseException:
+                # a key is only restored while it still holds the value written here, a single-key
+                # write that passed the txnActive check just before this transaction started is kept
+                for key, prev, ref in reversed(undo):
+                    restored = [False]
+                    def restore(cur):
+                        restored[0] = cur is ref
+                        return prev if restored[0] else cur
+                    self.__putNode(key, None, self.root, restore)
+                    self.__release(ref if restored[0] else prev)
+                raise
+            for key, prev, ref in undo:
+                self.__release(prev)
+            return results
+        finally:
+            for i in reversed(stripes):
+                self.txnLocks[i].release()
+            with self.txnGate:
+                self.txnActive -= 1
+            if self.subscriptions:
+                self.__throttle([p[1] for p in seq if p[0] != TXN_G])
+
+    def range(self, lo=None, hi=None):
+        """
+        Returns (key, value) pairs with lo <= key < hi in key order, None means unbounded.
+        The scan is weakly consistent: it is not atomic with respect to concurrent writers.
+        """
+        items = [(node.key, node.val) for node in self.__rangeNodes(self.root.right, lo, hi) if node.val is not None]
+        if self.store is not None:
+            items = [(key, self.store.decode(val)) for key, val in items]
+        return items
+
+    def scan(self, lo=None, hi=None, chunk=256):
+        """
+        Generator of (key, value) pairs with lo <= key < hi in key order, None means unbounded.
+        The walk goes chunk nodes at a time and a chunk is only emitted if no node it stepped on
+        was rotated or unlinked meanwhile, otherwise the chunk is walked again from the last emitted key.
+        Unlike range, a key that is present during the whole scan is never missed.
+        """
+        after = None
+        while True:
+            nodes = self.__scanChunk(lo, after, hi, chunk)
+            if nodes is None:
+                continue
+            for node, val in nodes:
+                if val is not None:
+                    yield node.key, self.__decode(val)
+            if len(nodes) < chunk:
+                return
+            after = nodes[-1][0].key
+
+    def get_array(self, keys, default=None, dtype=object):
+        """
+        Vectorized get: probes an array of keys with a single walk of the tree.
+        Returns an array of values with default for missing keys.
+        Keys missed by the walk are re-checked with get, since a concurrent rotation can move a node past the walk.
+        """
+        keys = np.asarray(keys)
+        order = np.argsort(keys, kind='stable')
+        skeys = keys[order].tolist()
+        svals = self.__probeSorted(self.root.right, skeys)
+        for i in range(len(svals)):
+            if svals[i] is None:
+                svals[i] = self.__getNode(self.root, skeys[i])
+                if svals[i] is None:
+                    svals[i] = default
+        if self.store is not None:
+            svals = [val if val is default else self.store.decode(val) for val in svals]
+        out = np.empty(len(keys), dtype=dtype)
+        out[order] = svals
+        return out
+
+    def range_to_array(self, lo=None, hi=None, dtype=None):
+        """
+        Returns (keys, values) arrays for lo <= key < hi in key order, see range.
+        """
+        keys = []
+        vals = []
+        for node in self.__rangeNodes(self.root.right, lo, hi):
+            val = node.val
+            if val is not None:
+                keys.append(node.key)
+                vals.append(self.__decode(val))
+        return np.array(keys, dtype=keyDtype(keys)), np.array(vals, dtype=dtype)
+
+    def to_arrays(self, dtype=None):
+        """
+        Exports all keys and values into contiguous arrays.
+        """
+        return self.range_to_array(None, None, dtype)
+
+    def rebalance(self):
+        """
+        Repairs the heights and balance of every node damaged since the last call (deferred mode only).
+        Safe to run concurrently with readers, writers and other repairs.
+        """
+        if self.damaged is None:
+            return
+        # duplicates are not skipped: a node queued again may have been damaged again after its last repair,
+        # and a node that is already repaired only costs a __nodeCondition
+        while True:
+            try:
+                node = self.damaged.popleft()
+            except IndexError:
+                return
+            self.__fixHeightAndRebalance(node)
+
+    def start_maintenance(self, interval=0.01):
+        """
+        Starts a background thread that calls rebalance() every interval seconds (deferred mode only).
+        """
+        if self.damaged is None or self.maintenance is not None:
+            return
+        self.maintenance = PeriodicTask(self.rebalance, interval, final=True).start()
+
+    def stop_maintenance(self):
+        """
+        Stops the maintenance thread after a last rebalance().
+        """
+        if self.maintenance is not None:
+            task = self.maintenance
+            self.maintenance = None
+            task.stop()
+
+    def min(self):
+        """
+        Returns the smallest key, or None if the tree is empty.
+        """
+        item = self.peek_min()
+        return None if item is None else item[0]
+
+    def max(self):
+        """
+        Returns the largest key, or None if the tree is empty.
+        """
+        item = self.peek_max()
+        return None if item is None else item[0]
+
+    def peek_min(self):
+        """
+        Returns the (key, value) pair with the smallest key, or None if the tree is empty.
+        O(1) while the cached minimum is valid, a removal of the minimum makes the next call walk the left spine.
+        """
+        return self.__peek(0)
+
+    def peek_max(self):
+        """
+        Returns the (key, value) pair with the largest key, or None if the tree is empty. See peek_min.
+        """
+        return self.__peek(1)
+
+    def pop_min(self, spread=1):
+        """
+        Removes and returns the (key, value) pair with the smallest key, or None if the tree is empty.
+        Concurrent consumers only contend on the lock of the node they remove, a consumer that loses
+        the race moves on to the next minimum. A key inserted while the pop runs may be passed over.
+        With spread > 1 the pop removes one of the spread smallest keys, picked at random, so that
+        concurrent consumers mostly claim different nodes instead of racing for the same one
+        (a relaxed priority queue: keys come out only roughly in order).
+        """
+        return self.__pop(0, spread)
+
+    def pop_max(self, spread=1):
+        """
+        Removes and returns the (key, value) pair with the largest key, or None if the tree is empty. See pop_min.
+        """
+        return self.__pop(1, spread)
+
+    def subscribe(self, lo=None, hi=None, capacity=1024):
+        """
+        Returns a pyChangeFeed.Subscription to the put and remove events with lo <= key < hi.
+        Events are emitted when the write commits, a removal has value None. Iterate the subscription
+        (or async for) to consume them, and close it to stop. Writers wait while more than capacity
+        events are waiting, so the consumer of a subscription must not write to its range.
+        Events of split, join and union are not reported.
+        """
+        sub = Subscription(self, lo, hi, capacity)
+        with self.feedLock:
+            self.subscriptions = self.subscriptions + (sub,)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.feedLock:
+            self.subscriptions = tuple(s for s in self.subscriptions if s is not sub)
+
+    def split(self, key):
+        """
+        Moves every key >= key into a new tree and returns it, in O(log n).
+        Nodes reachable by in-flight readers are never modified: the nodes on the split path are copied,
+        the results are published with a single pointer swap, and the replaced nodes are then unlinked
+        so that readers still on them retry. Must not run concurrently with writers on this tree.
+        """
+        # queued damage is repaired first, the copies on the split path are built from the stored heights
+        self.rebalance()
+        retired = []
+        routing = []
+        left, right = self.__splitNodes(self.root.right, key, retired, routing)
+        tree = self.__newTree()
+        tree.__publish(right, [], [])
+        self.__publish(left, retired, routing)
+        return tree
+
+    def join(self, tree):
+        """
+        Moves every key of tree into this tree, in O(log n). All keys of tree must be greater than the keys
+        of this tree. Safe for in-flight readers like split, must not run concurrently with writers on either tree.
+        """
+        if tree.store is not self.store:
+            raise ValueError("trees use different value stores, use union")
+        if tree.root.right is None:
+            return
+        self.rebalance()
+        tree.rebalance()
+        if self.root.right is not None and not self.__edgeNode(self.root.right, 1).key < self.__edgeNode(tree.root.right, -1).key:
+            raise ValueError("key ranges overlap, use union")
+        retired = []
+        routing = []
+        node, rest = self.__popMinNode(tree.root.right, retired, routing)
+        joined = self.__joinNodes(self.root.right, node, rest, retired, routing)
+        tree.__publish(None, retired, routing)
+        self.__publish(joined, [], [])
+
+    def union(self, tree):
+        """
+        Returns a new tree with the keys of both trees (values of tree win), in O(n).
+        The scans are weakly consistent, see range.
+        """
+        items = []
+        mine = iter(self.__storedItems(self))
+        theirs = iter(self.__storedItems(tree))
+        a = next(mine, None)
+        b = next(theirs, None)
+        while a is not None or b is not None:
+            if b is None or (a is not None and a[0] < b[0]):
+                items.append(a)
+                a = next(mine, None)
+            else:
+                items.append(b)
+                if a is not None and a[0] == b[0]:
+                    a = next(mine, None)
+                b = next(theirs, None)
+        utree = self.__newTree()
+        utree.__publish(self.__buildNodes(items, 0, len(items)), [], [])
+        return utree
+
+    def rebuild(self):
+        """
+        Repairs the height and balance of every node bottom-up and unlinks the routing nodes left with
+        fewer than two children, in O(n). Safe to run concurrently with readers, writers and rebalance().
+        Routing nodes with two children stay in place, see compact.
+        """
+        self.rebalance()
+        for node in self.__postOrderNodes(self.root.right):
+            self.__fixHeightAndRebalance(node)
+
+    def compact(self):
+        """
+        Replaces the tree with a perfectly balanced copy without routing nodes, in O(n).
+        The old nodes are unlinked once the copy is published, so in-flight readers retry like after split.
+        Must not run concurrently with writers.
+        """
+        retired = list(self.__rangeNodes(self.root.right, None, None))
+        items = [(node.key, node.val) for node in retired if node.val is not None]
+        self.__publish(self.__buildNodes(items, 0, len(items)), retired, [])
 
     def print(self):
         """
@@ -80,7 +514,7 @@ class ConAVL(object):
                     if key - cnode.key == 0:
                         return cnode.val
                     cversion = cnode.version
-                    if cversion.shrinking or cversion.unlinked:
+                    if cversion & SHRINKING or cversion & UNLINKED:
                         self.__waitUntilShrinkCompleted(cnode, cversion)
                         if node.version != version:
                             return CC_RETRY
@@ -105,7 +539,7 @@ class ConAVL(object):
                 if key - right.key == 0:
                     return right.val
                 cversion = right.version
-                if cversion.shrinking or cversion.unlinked:
+                if cversion & SHRINKING or cversion & UNLINKED:
                     self.__waitUntilShrinkCompleted(right, cversion)
                     # and then RETRY
                     continue
@@ -119,144 +553,556 @@ class ConAVL(object):
                     # RETRY
                     continue
 
-    def __putNode(self, key, newValue, root):
+    def __rangeNodes(self, node, lo, hi):
         """
-        Can be used to insert, update or remove a node.
+        In-order generator of the nodes with lo <= key < hi, including routing nodes.
         """
-        
-        # helper function of __putNode
-        def attemptInsertIntoEmpty(key, newValue, root):
-            """
-            Inserts when the tree is empty.
-            """
-            with root.lock:
-                if root.right is None:
-                    root.right = Node(key, newValue, root)
-                    root.height = 2
-                    result = True
+        stack = []
+        while stack or node is not None:
+            if node is not None:
+                if lo is not None and node.key < lo:
+                    node = node.right
                 else:
-                    result = False
-            return result
-        
-        # helper function of __putNode
-        def attemptUpdate(key, newValue, parent, node, version):
-            """
-            Inserts new node or updates old value.
-            """
-            cmp = key - node.key
-            if cmp == 0:
-                return attemptNodeUpdate(newValue, parent, node)
-            while True:
-                child = node.getChild(cmp)
-                if node.version != version:
-                    return CC_RETRY
-                
-                if child is None:
-                    # key is not present
-                    if newValue is None:
-                        # removal is requested
-                        return None
-                    else:
-                        # update will be an insert
-                        with node.lock:
-                            if node.version != version:
-                                return CC_RETRY
-                            if node.getChild(cmp) is not None:
-                                # lost a race with a concurrent insert
-                                # must retry in the outer loop
-                                success = False
-                                damaged = None
-                                # will RETRY
-                            else:
-                                if cmp <= -1:
-                                    fakeConflict(self)
-                                    node.left = Node(key, val=newValue, parent=node)
-                                else:
-                                    # key>root.key
-                                    fakeConflict(self)
-                                    node.right = Node(key, val=newValue, parent=node)
-
-                                success = True
-                                damaged = self.__fixHeight(node)
-
-                        if success == True:
-                            self.__fixHeightAndRebalance(damaged)
-                            return None
-                        # else: RETRY
+                    stack.append(node)
+                    node = node.left
+            else:
+                node = stack.pop()
+                if hi is not None and node.key >= hi:
+                    return
+                yield node
+                node = node.right
+
+    def __postOrderNodes(self, node):
+        """
+        Post-order generator of the nodes of a subtree, including routing nodes.
+        Each node's children are read once, so the walk ends even if rotations run concurrently.
+        """
+        stack = [(node, False)] if node is not None else []
+        while stack:
+            node, visited = stack.pop()
+            if visited:
+                yield node
+                continue
+            left = node.left
+            right = node.right
+            stack.append((node, True))
+            if right is not None:
+                stack.append((right, False))
+            if left is not None:
+                stack.append((left, False))
+
+    def __scanChunk(self, lo, after, hi, limit):
+        """
+        Returns up to limit (node, value) pairs with lo <= key < hi and key > after, including routing nodes,
+        or None if a node on the walk changed version before the walk ended.
+        """
+        seen = []
+        nodes = []
+        stack = []
+        node = self.root.right
+        while (stack or node is not None) and len(nodes) < limit:
+            if node is not None:
+                version = node.version
+                if version & SHRINKING or version & UNLINKED:
+                    self.__waitUntilShrinkCompleted(node, version)
+                    return None
+                seen.append((node, version))
+                if (lo is not None and node.key < lo) or (after is not None and node.key <= after):
+                    node = node.right
                 else:
-                    cversion = child.version
-                    if cversion.shrinking or cversion.unlinked:
-                        self.__waitUntilShrinkCompleted(child, cversion)
-                        # and then RETRY
-                    elif child is not node.getChild(cmp):
-                        continue # which is RETRY
-                    else:
-                        if node.version != version:
-                            return CC_RETRY
-                        vo = attemptUpdate(key, newValue, node, child, cversion)
-                        if vo != CC_RETRY:
-                            return vo
-                        # else: RETRY
-           
-        # helper function of __putNode
-        def attemptNodeUpdate(newValue, parent, node):
-            """
-            Updates node value.
-            """
-            if newValue is None:
-                # removal
-                if node.val is None:
-                    # already removed, nothing to do
+                    stack.append(node)
+                    node = node.left
+            else:
+                node = stack.pop()
+                if hi is not None and node.key >= hi:
+                    break
+                nodes.append((node, node.val))
+                node = node.right
+        for node, version in seen:
+            if node.version != version:
+                return None
+        return nodes
+
+    def __firstNode(self, dir):
+        """
+        Returns the data node with the smallest (dir=-1) or largest (dir=1) key, or None if the tree is empty.
+        The walk is validated like __scanChunk, routing nodes on the spine are skipped in order.
+        """
+        while True:
+            seen = []
+            stack = []
+            node = self.root.right
+            found = None
+            while stack or node is not None:
+                if node is not None:
+                    version = node.version
+                    if version & SHRINKING or version & UNLINKED:
+                        self.__waitUntilShrinkCompleted(node, version)
+                        break
+                    seen.append((node, version))
+                    stack.append(node)
+                    node = node.getChild(dir)
+                else:
+                    node = stack.pop()
+                    if node.val is not None:
+                        found = node
+                        break
+                    node = node.getChild(-dir)
+            else:
+                if all(node.version == version for node, version in seen):
                     return None
-            
-            if newValue is None and (node.left is None or node.right is None):
-                # potential unlink, get ready by locking the parent
-                with parent.lock:
-                    if parent.version.unlinked or node.parent != parent:
-                        return CC_RETRY
-                    with node.lock:
-                        prev = node.val
-                        if prev is None:
-                            return prev
-                        if not self.__attemptUnlink(parent, node):
-                            return CC_RETRY
-                    damaged = self.__fixHeight(parent)
-                self.__fixHeightAndRebalance(damaged)
-                return prev
+                continue
+            if found is not None and all(node.version == version for node, version in seen):
+                return found
+
+    def __extremeNode(self, side):
+        """
+        Returns the cached minimum (side 0) or maximum (side 1) data node, refreshing it if it was removed.
+        Inserts past the cached node invalidate it before returning (see __noteInsert), and bump the epoch
+        so that a refresh that raced with them does not install a stale node.
+        """
+        node = self.extrema[side]
+        if node is not None and node.val is not None and not node.version & UNLINKED:
+            return node
+        with self.extremaLock:
+            epoch = self.extremaEpoch[side]
+            self.extremaRefreshing[side] += 1
+        try:
+            node = self.__firstNode(1 if side else -1)
+        finally:
+            with self.extremaLock:
+                self.extremaRefreshing[side] -= 1
+                if self.extremaEpoch[side] == epoch:
+                    self.extrema[side] = node
+        return node
+
+    def __nearExtremeNode(self, side, rank):
+        """
+        Returns the data node rank places after the minimum (side 0) or before the maximum (side 1),
+        the farthest one found if the tree holds fewer keys, or None if it is empty. The walk is not
+        validated: a concurrent rotation only changes which of the nodes near the extreme is returned.
+        """
+        dir = 1 if side else -1
+        stack = []
+        node = self.root.right
+        found = None
+        while stack or node is not None:
+            if node is not None:
+                stack.append(node)
+                node = node.getChild(dir)
             else:
-                with node.lock:
-                    if node.version.unlinked:
-                        return CC_RETRY
-                    prev = node.val
-                    # retry if we now detect that unlink is possible
-                    if newValue is None and (node.left is None or node.right is None):
-                        return CC_RETRY
-                    node.val = newValue
-                return prev
-            
-        # =============================================================================
+                node = stack.pop()
+                if node.val is not None:
+                    found = node
+                    if not rank:
+                        break
+                    rank -= 1
+                node = node.getChild(-dir)
+        return found
+
+    def __noteInsert(self, key):
+        """
+        Invalidates the cached extrema that key may have replaced, called once key is in the tree.
+        """
+        for side in (0, 1):
+            node = self.extrema[side]
+            if node is None:
+                if not self.extremaRefreshing[side]:
+                    # a refresh that starts later walks past key
+                    continue
+            elif node.val is not None and not node.version & UNLINKED and (key >= node.key if side == 0 else key <= node.key):
+                continue
+            with self.extremaLock:
+                self.extremaEpoch[side] += 1
+                self.extrema[side] = None
+
+    def __encode(self, key, val):
+        """
+        Returns what Node.val keeps for val, see store.
+        """
+        if self.store is None:
+            return str(key) if val is None else val
+        return self.store.encode(key, val)
+
+    def __decode(self, val):
+        if self.store is None or val is None:
+            return val
+        return self.store.decode(val)
+
+    def __release(self, val):
+        """
+        Accounts for a stored value that was replaced or removed.
+        """
+        if self.store is not None and val is not None:
+            self.store.release(val)
+
+    def __emit(self, key, val):
+        """
+        Publishes a committed write to the matching subscriptions, called under the node lock.
+        """
+        if self.store is not None and val is not None:
+            val = self.store.decode(val)
+        for sub in self.subscriptions:
+            if sub.matches(key):
+                sub.push(key, val)
+
+    def __throttle(self, keys):
+        """
+        Waits for the subscriptions over capacity that receive the writes of keys,
+        called once the write released its locks.
+        """
+        for sub in self.subscriptions:
+            if any(sub.matches(key) for key in keys):
+                sub.throttle()
+
+    def __peek(self, side):
+        while True:
+            node = self.__extremeNode(side)
+            if node is None:
+                return None
+            key, val = node.key, node.val
+            if val is not None:
+                return key, self.__decode(val)
+
+    def __pop(self, side, spread):
+        while True:
+            rank = random.randrange(spread) if spread > 1 else 0
+            node = self.__nearExtremeNode(side, rank) if rank else self.__extremeNode(side)
+            if node is None:
+                return None
+            key = node.key
+            prev = self.__writeNode(key, None)
+            if prev is not None:
+                self.__release(prev)
+                return key, self.__decode(prev)
+            # another consumer removed it first
+
+    def __probeSorted(self, node, skeys):
+        """
+        Returns the values of the sorted probe keys skeys (None if not found).
+        Each subtree is only visited if some probe key can be in it.
+        """
+        svals = [None] * len(skeys)
+        stack = [(node, 0, len(skeys))] if node is not None and skeys else []
+        while stack:
+            node, lo, hi = stack.pop()
+            i = bisect_left(skeys, node.key, lo, hi)
+            j = bisect_right(skeys, node.key, i, hi)
+            val = node.val
+            for k in range(i, j):
+                svals[k] = val
+            left = node.left
+            right = node.right
+            if lo < i and left is not None:
+                stack.append((left, lo, i))
+            if j < hi and right is not None:
+                stack.append((right, j, hi))
+        return svals
+
+    def __writeNode(self, key, newValue, update=None):
+        """
+        __putNode for a write outside a transaction. While a transaction runs it holds the key's
+        transaction stripe, so it cannot land between the operations of that transaction. Otherwise
+        no second lock is taken on the write path.
+        """
+        if self.txnActive:
+            with self.txnLocks[hash(key) % TXN_STRIPES]:
+                prev = self.__putNode(key, newValue, self.root, update)
+        else:
+            prev = self.__putNode(key, newValue, self.root, update)
+        if self.subscriptions:
+            self.__throttle((key,))
+        return prev
+
+    def __putNode(self, key, newValue, root, update=None):
+        """
+        Can be used to insert, update or remove a node.
+        If update is given, the new value is computed as update(prev) under the node lock
+        (prev is None when key is not present), and newValue is ignored.
+        Returning prev from update leaves the tree unchanged.
+        Returns the previous value.
+        """
         while True:
             right = root.right
-            fakeConflict(self)
+            if self.scheduler is not None:
+                self.scheduler.point("descend")
             if right is None:
                 # key is not present
-                if newValue is None or attemptInsertIntoEmpty(key, newValue, root):
+                if newValue is None and update is None:
+                    return None
+                if self.__attemptInsertIntoEmpty(key, newValue, update, root):
+                    self.__noteInsert(key)
                     return None
                 # else: RETRY
             else:
                 cversion = right.version
-                if cversion.shrinking or cversion.unlinked:
+                if cversion & SHRINKING or cversion & UNLINKED:
                     self.__waitUntilShrinkCompleted(right, cversion)
                     # and then RETRY
                 elif right is root.right:
-                    fakeConflict(self)
-                    vo = attemptUpdate(key, newValue, root, right, cversion)
-                    if vo != CC_RETRY:
+                    if self.scheduler is not None:
+                        self.scheduler.point("update")
+                    vo = self.__attemptUpdate(key, newValue, update, root, right, cversion)
+                    if vo is not CC_RETRY:
+                        if vo is None and (newValue is not None or update is not None):
+                            # key may have been inserted
+                            self.__noteInsert(key)
                         return vo
                     # else: RETRY
                 else:
                     continue # RETRY
-        
+
+    def __attemptInsertIntoEmpty(self, key, newValue, update, root):
+        """
+        Inserts when the tree is empty.
+        """
+        with root.lock:
+            if root.right is None:
+                if update is not None:
+                    newValue = update(None)
+                    if newValue is None:
+                        return True
+                root.right = Node(key, newValue, root, self.newLock())
+                root.height = 2
+                if self.subscriptions:
+                    self.__emit(key, newValue)
+                result = True
+            else:
+                result = False
+        return result
+
+    def __attemptUpdate(self, key, newValue, update, parent, node, version):
+        """
+        Inserts new node or updates old value.
+        Descends with an explicit stack of (parent, node, version) frames: a CC_RETRY
+        pops a frame and retries from its parent, an empty stack is a CC_RETRY for the caller.
+        """
+        stack = [(parent, node, version)]
+        while stack:
+            parent, node, version = stack[-1]
+            cmp = key - node.key
+            if cmp == 0:
+                vo = self.__attemptNodeUpdate(newValue, update, parent, node)
+                if vo is CC_RETRY:
+                    stack.pop()
+                    continue
+                return vo
+
+            child = node.getChild(cmp)
+            if node.version != version:
+                stack.pop()
+                continue
+
+            if child is None:
+                # key is not present
+                if newValue is None and update is None:
+                    # removal is requested
+                    return None
+                # update will be an insert
+                with node.lock:
+                    if node.version != version:
+                        stack.pop()
+                        continue
+                    if node.getChild(cmp) is not None:
+                        # lost a race with a concurrent insert, RETRY
+                        continue
+                    if update is not None:
+                        newValue = update(None)
+                        if newValue is None:
+                            # conditional update declined to insert
+                            return None
+                    if self.scheduler is not None:
+                        self.scheduler.point("insert")
+                    if cmp <= -1:
+                        node.left = Node(key, val=newValue, parent=node, lock=self.newLock())
+                    else:
+                        # key>root.key
+                        node.right = Node(key, val=newValue, parent=node, lock=self.newLock())
+                    if self.subscriptions:
+                        self.__emit(key, newValue)
+                    damaged = self.__fixHeight(node)
+                self.__repair(damaged)
+                if self.damaged is not None and len(stack) >= self.deferDepth:
+                    # the new node is at depth len(stack) + 1
+                    self.rebalance()
+                return None
+            else:
+                cversion = child.version
+                if cversion & SHRINKING or cversion & UNLINKED:
+                    self.__waitUntilShrinkCompleted(child, cversion)
+                    # and then RETRY
+                elif child is not node.getChild(cmp):
+                    continue # which is RETRY
+                elif node.version != version:
+                    stack.pop()
+                else:
+                    stack.append((node, child, cversion))
+        return CC_RETRY
+
+    def __attemptNodeUpdate(self, newValue, update, parent, node):
+        """
+        Updates node value.
+        """
+        if update is not None:
+            with node.lock:
+                if node.version & UNLINKED:
+                    return CC_RETRY
+                prev = node.val
+                newValue = update(prev)
+                if newValue is prev:
+                    return prev
+                node.val = newValue
+                if self.subscriptions:
+                    self.__emit(node.key, newValue)
+            if newValue is None and (node.left is None or node.right is None):
+                # node is now a routing node, let the repair pass unlink it
+                self.__repair(node)
+            return prev
+
+        if newValue is None:
+            # removal
+            if node.val is None:
+                # already removed, nothing to do
+                return None
+
+        if newValue is None and (node.left is None or node.right is None):
+            # potential unlink, get ready by locking the parent
+            with parent.lock:
+                if parent.version & UNLINKED or node.parent != parent:
+                    return CC_RETRY
+                with node.lock:
+                    prev = node.val
+                    if prev is None:
+                        return prev
+                    if not self.__attemptUnlink(parent, node):
+                        return CC_RETRY
+                    if self.subscriptions:
+                        self.__emit(node.key, None)
+                damaged = self.__fixHeight(parent)
+            self.__repair(damaged)
+            return prev
+        else:
+            with node.lock:
+                if node.version & UNLINKED:
+                    return CC_RETRY
+                prev = node.val
+                # retry if we now detect that unlink is possible
+                if newValue is None and (node.left is None or node.right is None):
+                    return CC_RETRY
+                node.val = newValue
+                if self.subscriptions and (prev is not None or newValue is not None):
+                    self.__emit(node.key, newValue)
+            return prev
+
+    def __newTree(self):
+        """
+        Returns an empty tree built with the same constructor options.
+        """
+        return ConAVL(simulate=self.simulate, scheduler=self.scheduler, deferred=self.damaged is not None, defer_limit=self.deferLimit,
+                      defer_depth=self.deferDepth, profiler=self.profiler, store=self.store)
+
+    def __storedItems(self, tree):
+        """
+        Returns the (key, Node.val) pairs of tree as stored by this tree's store, see range.
+        """
+        items = [(node.key, node.val) for node in tree.__rangeNodes(tree.root.right, None, None) if node.val is not None]
+        if tree.store is not self.store:
+            items = [(key, self.__encode(key, tree.__decode(val))) for key, val in items]
+        return items
+
+    def __publish(self, node, retired, routing):
+        """
+        Makes node the actual root, then unlinks the retired nodes and repairs the routing copies left with one child.
+        """
+        with self.root.lock:
+            self.root.right = node
+            if node is not None:
+                node.parent = self.root
+        with self.extremaLock:
+            self.extrema = [None, None]
+            self.extremaEpoch = [self.extremaEpoch[0] + 1, self.extremaEpoch[1] + 1]
+        for node in retired:
+            node.version = node.version & ~SHRINKING | UNLINKED
+        for node in routing:
+            if node.left is None or node.right is None:
+                self.__fixHeightAndRebalance(node)
+
+    def __edgeNode(self, node, dir):
+        """
+        Returns the leftmost (dir<0) or rightmost (dir>0) node of a subtree.
+        """
+        while node.getChild(dir) is not None:
+            node = node.getChild(dir)
+        return node
+
+    def __copyNode(self, src, left, right, retired, routing):
+        """
+        Returns a copy of src with the given children, src is retired and a routing copy is recorded.
+        """
+        node = Node(src.key, src.val, None, self.newLock())
+        node.left = left
+        node.right = right
+        if left is not None:
+            left.parent = node
+        if right is not None:
+            right.parent = node
+        node.height = max(nodeHeight(left), nodeHeight(right)) + 1
+        retired.append(src)
+        if src.val is None:
+            routing.append(node)
+        return node
+
+    def __joinNodes(self, left, src, right, retired, routing):
+        """
+        Joins two subtrees with keys left < src.key < right, copying the nodes it changes.
+        A routing src is dropped (and retired).
+        """
+        if src.val is None:
+            retired.append(src)
+            return self.__joinTwoNodes(left, right, retired, routing)
+        return joinNodes(lambda src, left, right: self.__copyNode(src, left, right, retired, routing), nodeHeight, left, src, right)
+
+    def __joinTwoNodes(self, left, right, retired, routing):
+        """
+        Joins two subtrees with keys left < right.
+        """
+        if left is None:
+            return right
+        if right is None:
+            return left
+        node, rest = self.__popMinNode(right, retired, routing)
+        return self.__joinNodes(left, node, rest, retired, routing)
+
+    def __splitNodes(self, node, key, retired, routing):
+        """
+        Splits a subtree into (keys < key, keys >= key).
+        """
+        if node is None:
+            return None, None
+        if key <= node.key:
+            left, right = self.__splitNodes(node.left, key, retired, routing)
+            return left, self.__joinNodes(right, node, node.right, retired, routing)
+        left, right = self.__splitNodes(node.right, key, retired, routing)
+        return self.__joinNodes(node.left, node, left, retired, routing), right
+
+    def __popMinNode(self, node, retired, routing):
+        """
+        Removes the minimum node of a subtree, returns (minimum node, new subtree).
+        """
+        if node.left is None:
+            return node, node.right
+        minNode, rest = self.__popMinNode(node.left, retired, routing)
+        return minNode, self.__joinNodes(rest, node, node.right, retired, routing)
+
+    def __buildNodes(self, items, lo, hi):
+        """
+        Builds a balanced subtree from the sorted (key, value) pairs items[lo:hi].
+        """
+        if lo >= hi:
+            return None
+        mid = (lo + hi) // 2
+        return self.__copyNode(Node(items[mid][0], items[mid][1]), self.__buildNodes(items, lo, mid), self.__buildNodes(items, mid + 1, hi), [], [])
+
     def __attemptUnlink(self, parent, node):
         """
         Tries to unlink a node that should have already been removed.
@@ -281,8 +1127,7 @@ class ConAVL(object):
         if splice is not None:
             splice.parent = parent
 
-        # node.version = CC_UNLINKED
-        node.version.unlinked = True
+        node.version = node.version & ~SHRINKING | UNLINKED
         node.val = None
 
         return True
@@ -291,7 +1136,7 @@ class ConAVL(object):
         """
         Waits for lock to be released.
         """
-        if not version.shrinking:
+        if not version & SHRINKING:
             # version changed
             return
 
@@ -306,26 +1151,65 @@ class ConAVL(object):
         assert node.version != version
         return
 
+    def __repair(self, node):
+        """
+        Repairs the damage a writer left at node, or queues it in deferred mode.
+        """
+        if self.damaged is None:
+            self.__fixHeightAndRebalance(node)
+        elif node is not None:
+            self.damaged.append(node)
+            if len(self.damaged) > self.deferLimit:
+                self.rebalance()
+
     def __fixHeightAndRebalance(self, node):
         """
         Recursively rebalances and fixes the height of nodes, climbing up the three.
+        The heights of a node's children are read under the node's lock only, so a child fixed
+        concurrently can make the height just written stale, and a rotation returns only its deepest
+        damaged node: every node written is checked again once the climb is over.
         """
-        while node is not None and node.parent is not None:
+        pending = []
+        while True:
+            if node is None or node.parent is None:
+                if not pending:
+                    return
+                node = pending.pop()
+                continue
             c = self.__nodeCondition(node)
-            if c == NOTHING or node.version.unlinked == True:
+            if c == NOTHING or node.version & UNLINKED:
                 # node is fine, or node isn't repairable
-                return
+                node = None
+                continue
 
             if c is not UNLINK and c is not REBALANCE:
+                pending.append(node)
                 with node.lock:
                     node = self.__fixHeight(node)
 
             else:
                 nodeParent = node.parent
                 with nodeParent.lock:
-                    if nodeParent.version.unlinked == False and node.parent == nodeParent:
+                    if not nodeParent.version & UNLINKED and node.parent == nodeParent:
+                        isLeft = nodeParent.left is node
                         with node.lock:
-                            node = self.__rebalanceNode(nodeParent, node)
+                            damaged = self.__rebalanceNode(nodeParent, node)
+                        # root of the subtree, it is node unless node was rotated down or unlinked
+                        top = nodeParent.left if isLeft else nodeParent.right
+                        if damaged is not node or top is not node:
+                            # the rotations reach at most two levels below top
+                            pending.append(nodeParent)
+                            self.__pushSubtree(pending, top, 3)
+                        node = damaged
+
+    def __pushSubtree(self, pending, node, levels):
+        """
+        Appends the nodes of the first levels of a subtree to pending, the deepest last.
+        """
+        if node is not None and levels:
+            pending.append(node)
+            self.__pushSubtree(pending, node.left, levels - 1)
+            self.__pushSubtree(pending, node.right, levels - 1)
 
     def __fixHeight(self, node):
         """
@@ -334,7 +1218,7 @@ class ConAVL(object):
         cond = self.__nodeCondition(node)
         if cond == REBALANCE:
             # Need to rebalance
-            pass
+            return node
         elif cond == UNLINK:
             # Need to unlink
             return node
@@ -414,8 +1298,13 @@ class ConAVL(object):
                             return self.__rotateLeft(nodeParent, node, oldHeightLeft, nodeRight, nodeRightLeft, heightRightLeft, oldHeightRightRight)
                         else:
                             heightRightLeftRight = 0 if nodeRightLeft.right is None else nodeRightLeft.right.height
-                            if (oldHeightRightRight - heightRightLeftRight >= -1 and  oldHeightRightRight - heightRightLeftRight <= 1)and not ((oldHeightRightRight == 0 or heightRightLeftRight == 0) and nodeRight.val is None):
+                            if oldHeightRightRight - heightRightLeftRight >= -1 and oldHeightRightRight - heightRightLeftRight <= 1:
+                                # a routing nodeRight left with one child is unlinked by the caller
                                 return self.__rotateLeftOverRight(nodeParent, node, oldHeightLeft, nodeRight, nodeRightLeft, oldHeightRightRight, heightRightLeftRight)
+                            heightRightLeftLeft = 0 if nodeRightLeft.left is None else nodeRightLeft.left.height
+                            if heightRightLeftLeft - heightRightLeftRight > 1:
+                                # nodeRightLeft is unbalanced itself, no rotation of nodeRight helps before it is repaired
+                                return nodeRightLeft
                     return self.__rebalanceRight(node, nodeRight, nodeRightLeft, oldHeightRightRight)
 
     def __rebalanceRight(self, nodeParent, node, nodeLeft, oldHeightRight):
@@ -437,8 +1326,13 @@ class ConAVL(object):
                             return self.__rotateRight(nodeParent, node, oldHeightRight, nodeLeft, nodeLeftRight, heightLeftRight, oldHeightLeftLeft)
                         else:
                             heightLeftRightLeft = 0 if nodeLeftRight.left is None else nodeLeftRight.left.height
-                            if (oldHeightLeftLeft - heightLeftRightLeft >= -1 and oldHeightLeftLeft - heightLeftRightLeft <= 1) and not ((oldHeightLeftLeft == 0 or heightLeftRightLeft == 0) and nodeLeft.val is None):
+                            if oldHeightLeftLeft - heightLeftRightLeft >= -1 and oldHeightLeftLeft - heightLeftRightLeft <= 1:
+                                # a routing nodeLeft left with one child is unlinked by the caller
                                 return self.__rotateRightOverLeft(nodeParent, node, oldHeightRight, nodeLeft, nodeLeftRight, oldHeightLeftLeft, heightLeftRightLeft)
+                            heightLeftRightRight = 0 if nodeLeftRight.right is None else nodeLeftRight.right.height
+                            if heightLeftRightRight - heightLeftRightLeft > 1:
+                                # nodeLeftRight is unbalanced itself, no rotation of nodeLeft helps before it is repaired
+                                return nodeLeftRight
                     return self.__rebalanceLeft(node, nodeLeft, nodeLeftRight, oldHeightLeftLeft)
 
     def __rotateLeftOverRight(self, nodeParent, node, heightLeft, nodeRight, nodeRightLeft, heightRightRight, heightRightLeftRight):
@@ -448,8 +1342,8 @@ class ConAVL(object):
         nodeRightLeftRight = nodeRightLeft.right
         heightRightLeftLeft = 0 if nodeRightLeftLeft is None else nodeRightLeftLeft.height
 
-        node.version.shrinking = True
-        nodeRight.version.shrinking = True
+        node.version = node.version | SHRINKING
+        nodeRight.version = nodeRight.version | SHRINKING
 
         # Fix all the pointers
         node.right = nodeRightLeftLeft
@@ -478,13 +1372,15 @@ class ConAVL(object):
         nodeRight.height = newNodeRightHeight
         nodeRightLeft.height = max(newNodeHeight, newNodeRightHeight) + 1
 
-        node.version.shrinking = False
-        node.version.number += 1
-        nodeRight.version.shrinking = False
-        node.version.number += 1
+        node.version = nextVersion(node.version)
+        nodeRight.version = nextVersion(nodeRight.version)
 
         assert abs(heightRightRight - heightRightLeftRight) <= 1
 
+        if (nodeRightLeftRight is None or heightRightRight == 0) and nodeRight.val is None:
+            # nodeRight is a routing node with one child
+            return nodeRight
+
         if (heightRightLeftLeft - heightLeft < -1 or heightRightLeftLeft - heightLeft > 1) or ((nodeRightLeftLeft is None or heightLeft == 0) and node.val is None):
             return node
 
@@ -499,8 +1395,8 @@ class ConAVL(object):
         nodeLeftRightRight = nodeLeftRight.right
         heightLeftRightRight = 0 if nodeLeftRightRight is None else nodeLeftRightRight.height
 
-        node.version.shrinking = True
-        nodeLeft.version.shrinking = True
+        node.version = node.version | SHRINKING
+        nodeLeft.version = nodeLeft.version | SHRINKING
 
         # Fix all the pointers
 
@@ -530,13 +1426,14 @@ class ConAVL(object):
         nodeLeft.height = newNodeLeftHeight
         nodeLeftRight.height = max(newNodeHeight, newNodeLeftHeight) + 1
 
-        node.version.shrinking = False
-        node.version.number += 1
-        nodeLeft.version.shrinking = False
-        nodeLeft.version.number += 1
+        node.version = nextVersion(node.version)
+        nodeLeft.version = nextVersion(nodeLeft.version)
 
         assert abs(heightLeftLeft - heightLeftRightLeft) <= 1
-        assert not ((heightLeftLeft == 0 or nodeLeftRightLeft is None) and nodeLeft.val is None)
+
+        if (nodeLeftRightLeft is None or heightLeftLeft == 0) and nodeLeft.val is None:
+            # nodeLeft is a routing node with one child
+            return nodeLeft
 
         if (heightLeftRightRight - heightRight < -1 or heightLeftRightRight - heightRight > 1) or ((nodeLeftRightRight is None or heightRight == 0) and node.val is None):
             return node
@@ -548,7 +1445,7 @@ class ConAVL(object):
     def __rotateLeft(self, nodeParent, node, heightRigh, nodeRight, nodeRightLeft, heightRightLeft, heightRightRight):
         nodeParentLeft = nodeParent.left # sibling or itself
 
-        node.version.shrinking = True
+        node.version = node.version | SHRINKING
 
         # Fix all the pointers
         node.right = nodeRightLeft
@@ -569,8 +1466,7 @@ class ConAVL(object):
         node.height = newNodeHeight
         nodeRight.height = max(heightRightRight, newNodeHeight) + 1
 
-        node.version.shrinking = False
-        node.version.number += 1
+        node.version = nextVersion(node.version)
 
         if (heightRightLeft - heightRigh < -1 or heightRightLeft - heightRigh > 1) or ((nodeRightLeft is None or heightRigh == 0) and node.val is None):
             return node
@@ -583,7 +1479,7 @@ class ConAVL(object):
     def __rotateRight(self, nodeParent, node, heightRight, nodeLeft, nodeLeftRight, heightLeftRight, heightLeftLeft):
         nodeParentLeft = nodeParent.left  # sibling or itself
 
-        node.version.shrinking = True
+        node.version = node.version | SHRINKING
 
         # Fix all the pointers
         node.left = nodeLeftRight
@@ -604,8 +1500,7 @@ class ConAVL(object):
         node.height = newNodeHeight
         nodeLeft.height = max(heightLeftLeft, newNodeHeight) + 1
 
-        node.version.shrinking = False
-        node.version.number += 1
+        node.version = nextVersion(node.version)
 
         if (heightLeftRight - heightRight < -1 or heightLeftRight - heightRight > 1) or (
                 (nodeLeftRight is None or heightRight == 0) and node.val is None):
@@ -634,8 +1529,25 @@ class ConAVL(object):
             G = self.__buildGraph(G, root.right)
             display(Image(G.render()))
     
+class TXN(object):
+    """
+    Runs an operation sequence on a ConAVL as a single transaction,
+    see ConAVL.transaction.
+    """
+    def __init__(self):
+        self._result = None
+
+    def run(self, dtree, dseq):
+        self._result = dtree.transaction(dseq)
+
+    def get_result(self):
+        return self._result
+
 class Node(object):
-    def __init__(self, key, val = None, parent=None):
+    # no __dict__, and the version is a plain int: a node is a single object for the garbage collector
+    __slots__ = ("key", "val", "height", "parent", "left", "right", "version", "lock")
+
+    def __init__(self, key, val = None, parent=None, lock=None):
         self.key = key  # comparable, assume int
         self.val = val
         self.height =  1
@@ -646,24 +1558,9 @@ class Node(object):
         self.right = None
         
         # Concurrency Control
-        self.version = self.Version()
-        self.lock = threading.Lock()
-
-    class Version(object):
-        def __init__(self):
-            self.unlinked = False
-            self.growing = False
-            self.shrinking = False
-            self.number = 0
-
-        def __eq__(self, other):
-            if isinstance(other, self.__class__):
-                return self.__dict__ == other.__dict__
-            return False
+        self.version = 0  # number << 2 | SHRINKING | UNLINKED, never changed in place
+        self.lock = threading.Lock() if lock is None else lock
 
-        def __ne__(self, other):
-            return not self.__eq__(other)
-        
     def getChild(self, branch):
         """
         concurrent helper function, use branch=dkey-node.key
@@ -699,9 +1596,4 @@ def strTree(droot):
         return dstree
 
     stree = DFSNode(node, stree)
-    return stree
-
-def fakeConflict(self):
-    if self.simulate == True:
-        for i in range(random.randint(0,1000000)):
-            pass
\ No newline at end of file
+    return stree
\ No newline at end of file
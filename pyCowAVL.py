@@ -0,0 +1,218 @@
+# Copy-on-write AVL tree: lock-free readers, one writer at a time
+# Nodes are never modified once they are reachable. A write copies the nodes on the path from the root to its
+# key (O(log n) new nodes, rotations included) and publishes the new root with a single assignment, under
+# one writer lock. A reader loads the root once and walks that immutable version without any lock or retry,
+# so it sees every write either completely or not at all. Replaced nodes are freed by the garbage collector
+# once no reader holds their version.
+
+import random
+import sys
+import threading
+import time
+
+from pyConAVL import ConAVL
+from pyJoin import balancedNode
+
+class Node(object):
+    __slots__ = ("key", "val", "left", "right", "height")
+
+    def __init__(self, key, val, left, right):
+        self.key = key
+        self.val = val
+        self.left = left
+        self.right = right
+        self.height = max(height(left), height(right)) + 1  # leaf is 1
+
+def height(node):
+    return 0 if node is None else node.height
+
+def copy(src, left, right):
+    return Node(src.key, src.val, left, right)
+
+def balanced(src, left, right):
+    """
+    Returns a copy of src with children whose heights differ by at most 2, rotating (by copying) if needed.
+    """
+    return balancedNode(copy, height, src, left, right)
+
+def insert(node, key, val):
+    """
+    Returns (new subtree with key set to val, previous value of key or None).
+    """
+    if node is None:
+        return Node(key, val, None, None), None
+    if key < node.key:
+        left, prev = insert(node.left, key, val)
+        return balanced(node, left, node.right), prev
+    if key > node.key:
+        right, prev = insert(node.right, key, val)
+        return balanced(node, node.left, right), prev
+    return Node(key, val, node.left, node.right), node.val
+
+def delete(node, key):
+    """
+    Returns (new subtree without key, removed value or None). A missing key returns node itself.
+    """
+    if node is None:
+        return None, None
+    if key < node.key:
+        left, prev = delete(node.left, key)
+        return (node, None) if prev is None else (balanced(node, left, node.right), prev)
+    if key > node.key:
+        right, prev = delete(node.right, key)
+        return (node, None) if prev is None else (balanced(node, node.left, right), prev)
+    if node.left is None:
+        return node.right, node.val
+    if node.right is None:
+        return node.left, node.val
+    succ, rest = popMin(node.right)
+    return balanced(succ, node.left, rest), node.val
+
+def popMin(node):
+    """
+    Returns (minimum node, new subtree without it).
+    """
+    if node.left is None:
+        return node, node.right
+    minNode, rest = popMin(node.left)
+    return minNode, balanced(node, rest, node.right)
+
+class CowAVL(object):
+
+    def __init__(self):
+        self.root = None  # replaced as a whole by writers, never modified in place
+        self.size = 0
+        self.writeLock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the value of key, or None if key is not present. Never blocks.
+        """
+        node = self.root
+        while node is not None:
+            if key < node.key:
+                node = node.left
+            elif key > node.key:
+                node = node.right
+            else:
+                return node.val
+        return None
+
+    def put(self, key, val = None):
+        """
+        Inserts or updates key, the value defaults to str(key) like AVL.put. Returns the previous value.
+        """
+        val = str(key) if val is None else val
+        with self.writeLock:
+            root, prev = insert(self.root, key, val)
+            if prev is None:
+                self.size += 1
+            self.root = root
+        return prev
+
+    def remove(self, key):
+        """
+        Removes key if present, returns its value or None.
+        """
+        with self.writeLock:
+            root, prev = delete(self.root, key)
+            if prev is not None:
+                self.size -= 1
+                self.root = root
+        return prev
+
+    def range(self, lo=None, hi=None):
+        """
+        Returns (key, val) pairs with lo <= key < hi in key order, None means unbounded.
+        The pairs come from a single version of the tree.
+        """
+        items = []
+        stack = []
+        node = self.root
+        while stack or node is not None:
+            if node is not None:
+                if lo is not None and node.key < lo:
+                    node = node.right
+                else:
+                    stack.append(node)
+                    node = node.left
+            else:
+                node = stack.pop()
+                if hi is not None and node.key >= hi:
+                    break
+                items.append((node.key, node.val))
+                node = node.right
+        return items
+
+    def min(self):
+        """
+        Returns the smallest key, or None if the tree is empty.
+        """
+        node = self.root
+        if node is None:
+            return None
+        while node.left is not None:
+            node = node.left
+        return node.key
+
+    def max(self):
+        """
+        Returns the largest key, or None if the tree is empty.
+        """
+        node = self.root
+        if node is None:
+            return None
+        while node.right is not None:
+            node = node.right
+        return node.key
+
+    def snapshot(self):
+        """
+        Returns a copy of the tree in O(1): both trees share their nodes, and later writes
+        to either tree are not seen by the other.
+        """
+        with self.writeLock:
+            tree = CowAVL()
+            tree.root = self.root
+            tree.size = self.size
+        return tree
+
+    def __len__(self):
+        return self.size
+
+def benchmark(tree, nkeys, nops, nthreads, read_ratio, seed=0):
+    """
+    Runs nops random gets, puts and removes over nthreads threads against tree, prefilled with nkeys
+    of the keys in [0, 2 * nkeys). Returns the throughput in ops/s.
+    """
+    rnd = random.Random(seed)
+    for key in rnd.sample(range(2 * nkeys), nkeys):
+        tree.put(key, key)
+    def worker(i):
+        rnd = random.Random(seed * 1000 + i)
+        get, put, remove = tree.get, tree.put, tree.remove
+        for n in range(nops // nthreads):
+            key = rnd.randrange(2 * nkeys)
+            r = rnd.random()
+            if r < read_ratio:
+                get(key)
+            elif r < (1 + read_ratio) / 2:
+                put(key, key)
+            else:
+                remove(key)
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(nthreads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return nops // nthreads * nthreads / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    # usage: python pyCowAVL.py [nkeys] [nops] [nthreads] [read_ratio]
+    nkeys = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    nops = int(sys.argv[2]) if len(sys.argv) > 2 else 400000
+    nthreads = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    read_ratio = float(sys.argv[4]) if len(sys.argv) > 4 else 0.99
+    for name, tree in (("CowAVL", CowAVL()), ("ConAVL", ConAVL())):
+        print("%s: %.0f ops/s" % (name, benchmark(tree, nkeys, nops, nthreads, read_ratio)))
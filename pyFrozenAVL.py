@@ -0,0 +1,93 @@
+from array import array
+from bisect import bisect_left
+
+class FrozenAVL(object):
+    """
+    Read-only ordered index built from an AVL or ConAVL.
+    Keys and values live in two contiguous sorted arrays instead of Node objects,
+    integer keys are packed into an array('q').
+    The index never changes once built: rebuild it from the mutable tree and
+    swap the reference (a single assignment, so readers see either the old or the new index).
+    """
+
+    def __init__(self, tree=None, items=None):
+        """
+        Builds the index from tree (any object with a range() method returning sorted (key, val) pairs)
+        or directly from items, a sorted list of (key, val) pairs.
+        """
+        if items is None:
+            items = tree.range() if tree is not None else []
+        keys = [item[0] for item in items]
+        try:
+            self.keys = array('q', keys)
+        except (TypeError, OverflowError):
+            self.keys = keys
+        self.vals = [item[1] for item in items]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        i = bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def get(self, key):
+        """
+        Returns the value of key, or None if key is not present.
+        """
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.vals[i]
+        return None
+
+    def rank(self, key):
+        """
+        Returns the number of keys smaller than key.
+        """
+        return bisect_left(self.keys, key)
+
+    def select(self, i):
+        """
+        Returns the (key, val) pair with rank i.
+        """
+        return self.keys[i], self.vals[i]
+
+    def range(self, lo=None, hi=None):
+        """
+        Returns (key, val) pairs with lo <= key < hi in key order, None means unbounded.
+        """
+        i = 0 if lo is None else bisect_left(self.keys, lo)
+        j = len(self.keys) if hi is None else bisect_left(self.keys, hi)
+        return list(zip(self.keys[i:j], self.vals[i:j]))
+
+    def count(self, lo=None, hi=None):
+        """
+        Returns the number of keys with lo <= key < hi.
+        """
+        i = 0 if lo is None else bisect_left(self.keys, lo)
+        j = len(self.keys) if hi is None else bisect_left(self.keys, hi)
+        return max(j - i, 0)
+
+    def min(self):
+        """
+        Returns the smallest key, or None if the index is empty.
+        """
+        return self.keys[0] if self.keys else None
+
+    def max(self):
+        """
+        Returns the largest key, or None if the index is empty.
+        """
+        return self.keys[-1] if self.keys else None
+
+    def peek_min(self):
+        """
+        Returns the (key, val) pair of the smallest key, or None if the index is empty.
+        """
+        return self.select(0) if self.keys else None
+
+    def peek_max(self):
+        """
+        Returns the (key, val) pair of the largest key, or None if the index is empty.
+        """
+        return self.select(-1) if self.keys else None
@@ -0,0 +1,37 @@
+# Join-based AVL operations shared by AVL, ConAVL and CowAVL
+# A tree passes link(src, left, right), which returns a node with the key and value of src, the given children
+# and a fixed height (AVL relinks src in place, ConAVL and CowAVL copy it), and height(node). Only height
+# differences are compared, so a leaf may have height 0 (AVL) or 1 (ConAVL, CowAVL).
+# Reference: Blelloch, Ferizovic, Sun, Just Join for Parallel Ordered Sets, SPAA 2016
+
+def balancedNode(link, height, src, left, right):
+    """
+    Returns link(src, left, right) for children whose heights differ by at most 2, rotating if needed.
+    """
+    heightLeft = height(left)
+    heightRight = height(right)
+    if heightLeft - heightRight > 1:
+        leftLeft = left.left
+        leftRight = left.right
+        if height(leftLeft) >= height(leftRight):
+            return link(left, leftLeft, link(src, leftRight, right))
+        return link(leftRight, link(left, leftLeft, leftRight.left), link(src, leftRight.right, right))
+    if heightRight - heightLeft > 1:
+        rightLeft = right.left
+        rightRight = right.right
+        if height(rightRight) >= height(rightLeft):
+            return link(right, link(src, left, rightLeft), rightRight)
+        return link(rightLeft, link(src, left, rightLeft.left), link(right, rightLeft.right, rightRight))
+    return link(src, left, right)
+
+def joinNodes(link, height, left, src, right):
+    """
+    Joins two subtrees with keys left < src.key < right around src, in O(height difference).
+    """
+    heightLeft = height(left)
+    heightRight = height(right)
+    if heightLeft - heightRight > 1:
+        return balancedNode(link, height, left, left.left, joinNodes(link, height, left.right, src, right))
+    if heightRight - heightLeft > 1:
+        return balancedNode(link, height, right, joinNodes(link, height, left, src, right.left), right.right)
+    return link(src, left, right)
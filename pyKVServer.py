@@ -0,0 +1,258 @@
+# Key-value server around ConAVL, with a pipelining client and a load generator
+# Requests are frames (op, key, payload length, payload) on a TCP or Unix socket, keys are signed 64-bit
+# integers and values are bytes. A connection can send any number of requests without waiting, the server
+# answers in request order, and every batch of frames read at once is executed and answered with one write.
+
+import asyncio
+import random
+import struct
+import sys
+import time
+from collections import deque
+
+from pyConAVL import ConAVL
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Request operation codes
+
+OP_G = 0 # get (OP_G, KEY) -> value
+OP_P = 1 # put (OP_P, KEY, VAL)
+OP_R = 2 # remove (OP_R, KEY)
+OP_RANGE = 3 # range (OP_RANGE, LO, HI) -> [(key, value)]
+
+# Response status codes
+
+ST_OK = 0
+ST_MISSING = 1
+ST_ERROR = 2
+
+REQUEST = struct.Struct("<BqI")  # op, key, payload length
+RESPONSE = struct.Struct("<BI")  # status, payload length
+ITEM = struct.Struct("<qI")  # key, value length, inside a range payload
+HI = struct.Struct("<q")  # range payload
+
+# Runs of at least this many gets in a batch are answered with a single get_array walk
+GET_BATCH = 16
+
+def parseAddress(address):
+    """
+    Returns (host, port) for "host:port", or the path of a Unix socket.
+    """
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return host or "127.0.0.1", int(port)
+    return address
+
+class KVServer(object):
+
+    def __init__(self, tree=None):
+        self.tree = ConAVL() if tree is None else tree
+
+    async def serve(self, address="127.0.0.1:7070"):
+        """
+        Serves the tree on address ("host:port" or a Unix socket path) until cancelled.
+        """
+        address = parseAddress(address)
+        if isinstance(address, tuple):
+            server = await asyncio.start_server(self.handle, *address)
+        else:
+            server = await asyncio.start_unix_server(self.handle, address)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        buf = b""
+        try:
+            while True:
+                data = await reader.read(1 << 16)
+                if not data:
+                    break
+                buf += data
+                out, buf = self.execute(buf)
+                if out:
+                    writer.write(out)
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def execute(self, buf):
+        """
+        Runs every complete request of buf, returns (responses, unparsed rest of buf).
+        """
+        requests = []
+        pos = 0
+        while len(buf) - pos >= REQUEST.size:
+            op, key, size = REQUEST.unpack_from(buf, pos)
+            end = pos + REQUEST.size + size
+            if end > len(buf):
+                break
+            requests.append((op, key, buf[pos + REQUEST.size:end]))
+            pos = end
+
+        tree = self.tree
+        out = []
+        i = 0
+        while i < len(requests):
+            op, key, payload = requests[i]
+            if op == OP_G:
+                # consecutive gets are probed together
+                j = i + 1
+                while j < len(requests) and requests[j][0] == OP_G:
+                    j += 1
+                if np is not None and j - i >= GET_BATCH:
+                    vals = tree.get_array([r[1] for r in requests[i:j]])
+                else:
+                    vals = [tree.get(r[1]) for r in requests[i:j]]
+                for val in vals:
+                    out.append(RESPONSE.pack(ST_MISSING, 0) if val is None else RESPONSE.pack(ST_OK, len(val)) + val)
+                i = j
+                continue
+            if op == OP_P:
+                tree.put(key, payload)
+                out.append(RESPONSE.pack(ST_OK, 0))
+            elif op == OP_R:
+                tree.remove(key)
+                out.append(RESPONSE.pack(ST_OK, 0))
+            elif op == OP_RANGE and len(payload) == HI.size:
+                hi, = HI.unpack(payload)
+                items = b"".join(ITEM.pack(k, len(v)) + v for k, v in tree.range(key, hi))
+                out.append(RESPONSE.pack(ST_OK, len(items)) + items)
+            else:
+                out.append(RESPONSE.pack(ST_ERROR, 0))
+            i += 1
+        return b"".join(out), buf[pos:]
+
+class KVClient(object):
+    """
+    Pipelining client: requests are written immediately and answered in order by a reader task.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = deque()  # futures of the requests sent and not answered yet, oldest first
+        self.task = asyncio.ensure_future(self.__receive())
+
+    @classmethod
+    async def connect(cls, address="127.0.0.1:7070"):
+        address = parseAddress(address)
+        if isinstance(address, tuple):
+            reader, writer = await asyncio.open_connection(*address)
+        else:
+            reader, writer = await asyncio.open_unix_connection(address)
+        return cls(reader, writer)
+
+    def get(self, key):
+        """
+        Returns a future of the value of key (None if not present).
+        """
+        return self.__send(OP_G, key, b"")
+
+    def put(self, key, val):
+        return self.__send(OP_P, key, val)
+
+    def remove(self, key):
+        return self.__send(OP_R, key, b"")
+
+    def range(self, lo, hi):
+        """
+        Returns a future of the (key, value) pairs with lo <= key < hi.
+        """
+        return self.__send(OP_RANGE, lo, HI.pack(hi))
+
+    async def close(self):
+        self.writer.close()
+        await self.task
+
+    def __send(self, op, key, payload):
+        # packing raises on a bad key or payload: no future is queued for a request that is not sent
+        frame = REQUEST.pack(op, key, len(payload)) + payload
+        future = asyncio.get_running_loop().create_future()
+        future.op = op
+        self.pending.append(future)
+        self.writer.write(frame)
+        return future
+
+    async def __receive(self):
+        buf = b""
+        pos = 0
+        try:
+            while True:
+                data = await self.reader.read(1 << 16)
+                if not data:
+                    break
+                buf = buf[pos:] + data
+                pos = 0
+                while len(buf) - pos >= RESPONSE.size:
+                    status, size = RESPONSE.unpack_from(buf, pos)
+                    end = pos + RESPONSE.size + size
+                    if end > len(buf):
+                        break
+                    payload = buf[pos + RESPONSE.size:end]
+                    pos = end
+                    future = self.pending.popleft()
+                    if future.done():
+                        # cancelled by the caller, the reply is only consumed
+                        continue
+                    if status == ST_ERROR:
+                        future.set_exception(ValueError("server rejected op %d" % future.op))
+                    elif future.op == OP_RANGE:
+                        future.set_result(self.__items(payload))
+                    else:
+                        future.set_result(payload if status == ST_OK and future.op == OP_G else None)
+        finally:
+            for future in self.pending:
+                if not future.done():
+                    future.set_exception(ConnectionError("connection closed"))
+            self.pending.clear()
+
+    def __items(self, payload):
+        items = []
+        pos = 0
+        while pos < len(payload):
+            key, size = ITEM.unpack_from(payload, pos)
+            pos += ITEM.size
+            items.append((key, payload[pos:pos + size]))
+            pos += size
+        return items
+
+async def loadTest(address="127.0.0.1:7070", nconns=4, nops=100000, depth=64, nkeys=10000, get_ratio=0.9, seed=0):
+    """
+    Runs nops random gets and puts over nconns connections, keeping up to depth requests
+    in flight per connection. Returns the throughput in ops/s.
+    """
+    async def worker(i):
+        rnd = random.Random(seed * 1000 + i)
+        client = await KVClient.connect(address)
+        window = []
+        for n in range(nops // nconns):
+            key = rnd.randrange(nkeys)
+            window.append(client.get(key) if rnd.random() < get_ratio else client.put(key, b"%d" % n))
+            if len(window) >= depth:
+                await asyncio.gather(*window)
+                window = []
+        await asyncio.gather(*window)
+        await client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(i) for i in range(nconns)])
+    return nops // nconns * nconns / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    # usage: python pyKVServer.py serve [address]
+    #        python pyKVServer.py load [address] [nops] [depth] [nconns]
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "serve"
+    address = sys.argv[2] if len(sys.argv) > 2 else "127.0.0.1:7070"
+    if cmd == "serve":
+        asyncio.run(KVServer().serve(address))
+    else:
+        nops = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+        depth = int(sys.argv[4]) if len(sys.argv) > 4 else 64
+        nconns = int(sys.argv[5]) if len(sys.argv) > 5 else 4
+        print("%.0f ops/s" % asyncio.run(loadTest(address, nconns, nops, depth)))
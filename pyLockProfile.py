@@ -0,0 +1,162 @@
+# Lock hold-time and wait-time profiling for ConAVL
+# Every node lock of a profiled tree is wrapped, acquisitions are tagged with the ConAVL call path
+# that took them, and the rotation or unlink performed while a lock is held is appended to the tag.
+# Histograms use power-of-two nanosecond buckets, the folded export can be fed to flamegraph.pl.
+
+import sys
+import threading
+import time
+
+# ConAVL methods whose execution is appended to the tag of every lock held at that moment
+TAGGED_OPS = ["rotateLeft", "rotateRight", "rotateLeftOverRight", "rotateRightOverLeft", "attemptUnlink"]
+
+class Histogram(object):
+    """
+    Power-of-two histogram of durations in nanoseconds.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = {}  # bit length of the duration -> count
+
+    def add(self, ns):
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+        b = ns.bit_length()
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+
+    def percentile(self, p):
+        """
+        Returns the upper bound (ns) of the bucket holding the p-th percentile.
+        """
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= p / 100.0 * self.count:
+                return (1 << b) - 1
+        return 0
+
+class LockProfiler(object):
+
+    def __init__(self):
+        self.hold = {}  # site -> Histogram
+        self.wait = {}  # site -> Histogram
+        self.statsLock = threading.Lock()
+        self.local = threading.local()
+        self.filename = None
+
+    def attach(self, tree):
+        """
+        Profiles tree: wraps its lock factory and tags its rotation and unlink methods.
+        Called by ConAVL(profiler=...) before the first node is created.
+        """
+        cls = type(tree)
+        self.filename = sys.modules[cls.__module__].__file__
+        lockFactory = tree.newLock
+        tree.newLock = lambda: ProfiledLock(self, lockFactory())
+        for op in TAGGED_OPS:
+            name = "_%s__%s" % (cls.__name__, op)
+            setattr(tree, name, self.__tagged(op, getattr(tree, name)))
+
+    def held(self):
+        """
+        Returns the [lock, site, acquired at, op] entries of the locks held by the current thread.
+        """
+        try:
+            return self.local.held
+        except AttributeError:
+            self.local.held = []
+            return self.local.held
+
+    def site(self, frame):
+        """
+        Returns the call path of frame inside the profiled module, outermost first, joined with ';'.
+        """
+        names = []
+        while frame is not None and frame.f_code.co_filename == self.filename:
+            names.append(frame.f_code.co_name.lstrip("_"))
+            frame = frame.f_back
+        names.reverse()
+        return ";".join(names)
+
+    def record(self, table, site, ns):
+        with self.statsLock:
+            h = table.get(site)
+            if h is None:
+                h = table[site] = Histogram()
+            h.add(ns)
+
+    def report(self, kind="hold"):
+        """
+        Returns (site, count, total ns, p50 ns, p99 ns, max ns) rows sorted by total time.
+        """
+        table = self.hold if kind == "hold" else self.wait
+        with self.statsLock:
+            rows = [(site, h.count, h.total, h.percentile(50), h.percentile(99), h.max) for site, h in table.items()]
+        rows.sort(key=lambda r: -r[2])
+        return rows
+
+    def folded(self, kind="hold"):
+        """
+        Returns the profile in folded stack format ("frame;frame;... microseconds" per line).
+        """
+        return "\n".join("%s %d" % (r[0], r[2] // 1000) for r in self.report(kind) if r[2] >= 1000)
+
+    def reset(self):
+        with self.statsLock:
+            self.hold = {}
+            self.wait = {}
+
+    def __tagged(self, op, method):
+        def run(*args):
+            for entry in self.held():
+                if entry[3] is None:
+                    entry[3] = op
+            return method(*args)
+        return run
+
+class ProfiledLock(object):
+    """
+    Wraps a node lock, recording wait time on acquire and hold time on release.
+    """
+
+    def __init__(self, profiler, lock):
+        self.profiler = profiler
+        self.lock = lock
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self.__acquire(sys._getframe(1), blocking, timeout)
+
+    def __acquire(self, frame, blocking=True, timeout=-1):
+        prof = self.profiler
+        site = prof.site(frame)
+        start = time.perf_counter_ns()
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        acquired = time.perf_counter_ns()
+        prof.record(prof.wait, site, acquired - start)
+        prof.held().append([self, site, acquired, None])
+        return True
+
+    def release(self):
+        prof = self.profiler
+        held = prof.held()
+        for i in range(len(held) - 1, -1, -1):
+            if held[i][0] is self:
+                lock, site, acquired, op = held.pop(i)
+                prof.record(prof.hold, site if op is None else site + ";" + op, time.perf_counter_ns() - acquired)
+                break
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.__acquire(sys._getframe(1))
+        return self
+
+    def __exit__(self, *args):
+        self.release()
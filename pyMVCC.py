@@ -0,0 +1,167 @@
+# Multi-version reads on top of ConAVL
+# Every key holds a chain of versions, newest first, stamped by a global write counter.
+# A snapshot pins the highest stamp below which every write has been installed, and reads the
+# newest version of each key that is not newer than its pin, without taking any lock held by writers.
+# Versions older than what the oldest pinned snapshot can see are pruned by writers and by vacuum().
+
+import threading
+
+from pyConAVL import ConAVL
+
+class Version(object):
+    """
+    One value of a key, val None is a removal (tombstone).
+    Versions compare by identity, so remove_if(key, version) only removes this very chain.
+    """
+    __slots__ = ("stamp", "val", "older")
+
+    def __init__(self, stamp, val, older):
+        self.stamp = stamp
+        self.val = val
+        self.older = older
+
+def readVersion(head, pin):
+    """
+    Returns the value of the newest version of the chain head that is not newer than pin.
+    """
+    while head is not None and head.stamp > pin:
+        head = head.older
+    return None if head is None else head.val
+
+class MVCCConAVL(object):
+
+    def __init__(self, **kwargs):
+        """
+        kwargs are passed to the underlying ConAVL.
+        """
+        self.tree = ConAVL(**kwargs)
+        self.stampLock = threading.Lock()
+        self.stamp = 0  # last stamp handed out to a writer
+        self.visible = 0  # every write stamped <= visible is installed
+        self.inflight = set()  # stamps of the writes not installed yet
+        self.pins = {}  # pinned stamp -> number of open snapshots
+
+    def get(self, key):
+        """
+        Returns the latest value of key, or None if it is not present.
+        The head of the chain is the newest installed version, even if writes with lower stamps
+        to other keys are still in flight: visible only pins snapshots.
+        """
+        head = self.tree.get(key)
+        return None if head is None else head.val
+
+    def put(self, key, val = None):
+        """
+        Inserts or updates key with a new version, see ConAVL.put.
+        """
+        self.__write(key, str(key) if val is None else val)
+
+    def remove(self, key):
+        """
+        Removes key by adding a tombstone version, the node is removed by vacuum()
+        once no snapshot can see the previous versions.
+        """
+        self.__write(key, None)
+
+    def snapshot(self):
+        """
+        Returns a Snapshot of the latest installed writes, to be closed (or used as a context manager).
+        """
+        with self.stampLock:
+            pin = self.visible
+            self.pins[pin] = self.pins.get(pin, 0) + 1
+        return Snapshot(self, pin)
+
+    def vacuum(self):
+        """
+        Prunes the versions that no open snapshot can see, and removes the keys whose
+        only visible version is a tombstone. Returns the number of removed keys.
+        """
+        oldest = self.oldest()
+        removed = 0
+        for key, head in self.tree.scan():
+            self.__prune(head, oldest)
+            if head.val is None and head.stamp <= oldest and self.tree.remove_if(key, head):
+                removed += 1
+        return removed
+
+    def oldest(self):
+        """
+        Returns the pin of the oldest open snapshot, or the visible stamp if there is none.
+        """
+        with self.stampLock:
+            return min(self.pins) if self.pins else self.visible
+
+    def release(self, pin):
+        with self.stampLock:
+            count = self.pins[pin] - 1
+            if count:
+                self.pins[pin] = count
+            else:
+                del self.pins[pin]
+
+    def __write(self, key, val):
+        stamp = [None]
+        def update(head):
+            # runs under the node lock of key, so the chain stays ordered by stamp
+            if val is None and (head is None or head.val is None):
+                # nothing to remove
+                return head
+            with self.stampLock:
+                self.stamp += 1
+                stamp[0] = self.stamp
+                self.inflight.add(self.stamp)
+                oldest = min(self.pins) if self.pins else self.visible
+            self.__prune(head, oldest)
+            return Version(stamp[0], val, head)
+        try:
+            self.tree.compute(key, update)
+        finally:
+            if stamp[0] is not None:
+                with self.stampLock:
+                    self.inflight.discard(stamp[0])
+                    self.visible = min(self.inflight) - 1 if self.inflight else self.stamp
+
+    def __prune(self, head, oldest):
+        # the first version not newer than oldest is the last one any snapshot can read
+        while head is not None:
+            if head.stamp <= oldest:
+                head.older = None
+                return
+            head = head.older
+
+class Snapshot(object):
+    """
+    Consistent read-only view of an MVCCConAVL, writers are not blocked while it is open.
+    """
+
+    def __init__(self, mvcc, pin):
+        self.mvcc = mvcc
+        self.pin = pin
+        self.closed = False
+
+    def get(self, key):
+        return readVersion(self.mvcc.tree.get(key), self.pin)
+
+    def scan(self, lo=None, hi=None):
+        """
+        Generator of the (key, value) pairs with lo <= key < hi as of the snapshot, see ConAVL.scan.
+        """
+        for key, head in self.mvcc.tree.scan(lo, hi):
+            val = readVersion(head, self.pin)
+            if val is not None:
+                yield key, val
+
+    def range(self, lo=None, hi=None):
+        return list(self.scan(lo, hi))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.mvcc.release(self.pin)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
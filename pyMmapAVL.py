@@ -0,0 +1,357 @@
+# Out-of-core AVL tree stored in a memory-mapped file
+# Nodes are fixed-size records (key, value, left, right, height) addressed by record index instead of
+# object pointers, record 0 is the file header. Keys and values are signed 64-bit integers.
+# Decoded records are kept in a write-back cache that is flushed to the map in bulk.
+
+import mmap
+import operator
+import os
+import struct
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MAGIC = b"pyAVLmm1"
+HEADER = struct.Struct("<8sqqqq")  # magic, root, count, records in use, head of the free list
+RECORD = struct.Struct("<qqqqi4x")  # key, val, left, right, height (0 is no node, leaf is 1)
+SIZE = RECORD.size
+
+# record fields
+KEY = 0
+VAL = 1
+LEFT = 2
+RIGHT = 3
+HEIGHT = 4
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+def int64(x):
+    """
+    Returns x as an int, raises TypeError if it is not an integer and OverflowError if it does not fit in 64 bits.
+    """
+    x = operator.index(x)
+    if not INT64_MIN <= x <= INT64_MAX:
+        raise OverflowError("%d does not fit in a signed 64-bit integer" % x)
+    return x
+
+class MmapAVL(object):
+
+    def __init__(self, path, cache_size=1 << 16, capacity=1 << 10):
+        """
+        Opens the tree stored at path, or creates it with room for capacity records.
+        Up to cache_size decoded records are cached, the dirty ones are written back by flush().
+        """
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, "r+b" if exists else "w+b")
+        if not exists:
+            self.file.truncate(max(capacity, 2) * SIZE)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.cacheSize = cache_size
+        self.cache = {}  # record index -> [key, val, left, right, height]
+        self.dirty = set()
+        if exists:
+            magic, self.root, self.count, self.used, self.free = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC:
+                raise ValueError("%s is not a tree file" % path)
+        else:
+            self.root, self.count, self.used, self.free = 0, 0, 1, 0
+            self.flush()
+
+    @classmethod
+    def build(cls, path, keys, vals=None, cache_size=1 << 16):
+        """
+        Creates a balanced tree at path from sorted, distinct keys (vals default to the keys), in O(n).
+        Records are written with numpy in chunks, so keys and vals can be memory-mapped arrays.
+        """
+        n = len(keys)
+        with open(path, "w+b") as f:
+            f.truncate((n + 1) * SIZE)
+        dtype = np.dtype({"names": ["key", "val", "left", "right", "height"],
+                          "formats": ["<i8", "<i8", "<i8", "<i8", "<i4"], "itemsize": SIZE})
+        records = np.memmap(path, dtype=dtype, mode="r+")
+        chunk = 1 << 22
+        for i in range(0, n, chunk):
+            records["key"][i + 1:i + 1 + chunk] = keys[i:i + chunk]
+            records["val"][i + 1:i + 1 + chunk] = (keys if vals is None else vals)[i:i + chunk]
+        # key i is stored at record i + 1, the subtree of [lo, hi) is rooted at its middle key
+        def link(lo, hi):
+            if hi - lo > chunk:
+                mid = (lo + hi) // 2
+                records[mid + 1] = (keys[mid], (keys if vals is None else vals)[mid], link(lo, mid), link(mid + 1, hi), (hi - lo).bit_length())
+                return mid + 1
+            los = np.array([lo], dtype=np.int64)
+            his = np.array([hi], dtype=np.int64)
+            while los.size:
+                mids = (los + his) // 2
+                rec = records[mids + 1]
+                rec["left"] = np.where(mids > los, (los + mids) // 2 + 1, 0)
+                rec["right"] = np.where(his > mids + 1, (mids + 1 + his) // 2 + 1, 0)
+                rec["height"] = np.floor(np.log2(his - los)).astype(np.int32) + 1
+                records[mids + 1] = rec
+                los, his = np.concatenate((los, mids + 1)), np.concatenate((mids, his))
+                keep = his > los
+                los, his = los[keep], his[keep]
+            return (lo + hi) // 2 + 1
+        root = link(0, n) if n else 0
+        records.flush()
+        del records
+        with open(path, "r+b") as f:
+            f.write(HEADER.pack(MAGIC, root, n, n + 1, 0))
+        return cls(path, cache_size)
+
+    def get(self, key):
+        """
+        Returns the value of key, or None if key is not present.
+        """
+        i = self.root
+        while i:
+            node = self.__node(i)
+            if key == node[KEY]:
+                val = node[VAL]
+                break
+            i = node[LEFT] if key < node[KEY] else node[RIGHT]
+        else:
+            val = None
+        self.__trim()
+        return val
+
+    def put(self, key, val = None):
+        """
+        Inserts or updates key, the value defaults to the key.
+        Key and value are checked before any record changes, records are only packed by flush().
+        """
+        key = int64(key)
+        val = key if val is None else int64(val)
+        path = []
+        i = self.root
+        while i:
+            node = self.__node(i)
+            if key == node[KEY]:
+                node[VAL] = val
+                self.dirty.add(i)
+                self.__trim()
+                return
+            path.append(i)
+            i = node[LEFT] if key < node[KEY] else node[RIGHT]
+        i = self.__alloc([key, val, 0, 0, 1])
+        if not path:
+            self.root = i
+        else:
+            parent = self.__node(path[-1])
+            parent[LEFT if key < parent[KEY] else RIGHT] = i
+            self.dirty.add(path[-1])
+        self.count += 1
+        self.__retrace(path)
+        self.__trim()
+
+    def remove(self, key):
+        """
+        Removes key if present, its record is recycled by later inserts.
+        """
+        path = []
+        i = self.root
+        while i:
+            node = self.__node(i)
+            if key == node[KEY]:
+                break
+            path.append(i)
+            i = node[LEFT] if key < node[KEY] else node[RIGHT]
+        else:
+            self.__trim()
+            return
+        if node[LEFT] and node[RIGHT]:
+            # move the successor here and remove the successor record instead
+            path.append(i)
+            j = node[RIGHT]
+            while self.__node(j)[LEFT]:
+                path.append(j)
+                j = self.__node(j)[LEFT]
+            succ = self.__node(j)
+            node[KEY], node[VAL] = succ[KEY], succ[VAL]
+            self.dirty.add(i)
+            i, node = j, succ
+        self.__link(path, i, node[LEFT] or node[RIGHT])
+        self.__release(i)
+        self.count -= 1
+        self.__retrace(path)
+        self.__trim()
+
+    def range(self, lo=None, hi=None):
+        """
+        Returns (key, val) pairs with lo <= key < hi in key order, None means unbounded.
+        """
+        items = []
+        stack = []
+        i = self.root
+        while stack or i:
+            if i:
+                node = self.__node(i)
+                if lo is not None and node[KEY] < lo:
+                    i = node[RIGHT]
+                else:
+                    stack.append(node)
+                    i = node[LEFT]
+            else:
+                node = stack.pop()
+                if hi is not None and node[KEY] >= hi:
+                    break
+                items.append((node[KEY], node[VAL]))
+                i = node[RIGHT]
+        self.__trim()
+        return items
+
+    def __len__(self):
+        return self.count
+
+    def flush(self):
+        """
+        Writes the dirty records and the header back to the file.
+        """
+        self.__writeBack()
+        self.map.flush()
+
+    def close(self):
+        self.flush()
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __node(self, i):
+        node = self.cache.get(i)
+        if node is None:
+            node = self.cache[i] = list(RECORD.unpack_from(self.map, i * SIZE))
+        return node
+
+    def __trim(self):
+        # only called between operations, so no caller holds a decoded record that gets dropped
+        if len(self.cache) > self.cacheSize:
+            self.__writeBack()
+            self.cache = {}
+
+    def __writeBack(self):
+        """
+        Copies the dirty records and the header into the map, the OS writes the pages back.
+        """
+        for i in self.dirty:
+            RECORD.pack_into(self.map, i * SIZE, *self.cache[i])
+        self.dirty = set()
+        HEADER.pack_into(self.map, 0, MAGIC, self.root, self.count, self.used, self.free)
+
+    def __alloc(self, node):
+        if self.free:
+            i = self.free
+            self.free = self.__node(i)[LEFT]
+        else:
+            i = self.used
+            self.used += 1
+            if self.used * SIZE > len(self.map):
+                self.map.resize(2 * len(self.map))
+        self.cache[i] = node
+        self.dirty.add(i)
+        return i
+
+    def __release(self, i):
+        # freed records are chained through their left field
+        self.cache[i] = [0, 0, self.free, 0, 0]
+        self.dirty.add(i)
+        self.free = i
+
+    def __link(self, path, old, i):
+        """
+        Replaces the child old of path[-1] (or the root if path is empty) with i.
+        """
+        if not path:
+            self.root = i
+            return
+        parent = self.__node(path[-1])
+        parent[LEFT if parent[LEFT] == old else RIGHT] = i
+        self.dirty.add(path[-1])
+
+    def __retrace(self, path):
+        """
+        Fixes heights and rotates bottom-up along path.
+        """
+        while path:
+            i = path.pop()
+            node = self.__node(i)
+            height = node[HEIGHT]
+            j = self.__balance(i)
+            if j != i:
+                self.__link(path, i, j)
+            elif self.__node(j)[HEIGHT] == height:
+                return
+
+    def __height(self, i):
+        return self.__node(i)[HEIGHT] if i else 0
+
+    def __fixHeight(self, i):
+        node = self.__node(i)
+        node[HEIGHT] = max(self.__height(node[LEFT]), self.__height(node[RIGHT])) + 1
+        self.dirty.add(i)
+
+    def __balance(self, i):
+        """
+        Rebalances the subtree rooted at i, returns its new root.
+        """
+        node = self.__node(i)
+        bal = self.__height(node[LEFT]) - self.__height(node[RIGHT])
+        if bal > 1:
+            left = self.__node(node[LEFT])
+            if self.__height(left[LEFT]) < self.__height(left[RIGHT]):
+                node[LEFT] = self.__rotateLeft(node[LEFT])
+            return self.__rotateRight(i)
+        if bal < -1:
+            right = self.__node(node[RIGHT])
+            if self.__height(right[RIGHT]) < self.__height(right[LEFT]):
+                node[RIGHT] = self.__rotateRight(node[RIGHT])
+            return self.__rotateLeft(i)
+        self.__fixHeight(i)
+        return i
+
+    def __rotateRight(self, i):
+        node = self.__node(i)
+        j = node[LEFT]
+        node[LEFT] = self.__node(j)[RIGHT]
+        self.__node(j)[RIGHT] = i
+        self.__fixHeight(i)
+        self.__fixHeight(j)
+        return j
+
+    def __rotateLeft(self, i):
+        node = self.__node(i)
+        j = node[RIGHT]
+        node[RIGHT] = self.__node(j)[LEFT]
+        self.__node(j)[LEFT] = i
+        self.__fixHeight(i)
+        self.__fixHeight(j)
+        return j
+
+if __name__ == "__main__":
+    # usage: python pyMmapAVL.py path [nkeys] [nops]
+    path = sys.argv[1]
+    nkeys = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    nops = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+    start = time.perf_counter()
+    tree = MmapAVL.build(path, np.arange(0, 2 * nkeys, 2, dtype=np.int64))
+    print("build: %d keys in %.1f s, %d MB" % (nkeys, time.perf_counter() - start, os.path.getsize(path) >> 20))
+    rnd = np.random.default_rng(0)
+    probes = (rnd.integers(0, nkeys, nops) * 2).tolist()
+    inserts = (rnd.integers(0, nkeys, nops) * 2 + 1).tolist()
+    for name, op, keys in (("get", tree.get, probes), ("put", tree.put, inserts), ("remove", tree.remove, inserts)):
+        start = time.perf_counter()
+        for key in keys:
+            op(key)
+        print("%s: %.0f ops/s" % (name, nops / (time.perf_counter() - start)))
+    start = time.perf_counter()
+    tree.close()
+    print("close: %.2f s" % (time.perf_counter() - start))
@@ -0,0 +1,38 @@
+# Background thread that calls a function at a fixed interval
+# Runs the ConAVL maintenance, the TTL expiry and the shape monitor. The thread is a daemon and sleeps on an
+# Event, so stop() wakes it at once instead of waiting for the end of the interval.
+
+import threading
+
+class PeriodicTask(object):
+
+    def __init__(self, fn, interval, final=False):
+        """
+        Calls fn() every interval seconds once started. With final=True the thread calls fn()
+        one last time when it is stopped.
+        """
+        self.fn = fn
+        self.interval = interval
+        self.final = final
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self):
+        """
+        Starts the thread, returns self.
+        """
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the thread and waits until it ended.
+        """
+        self.stopped.set()
+        self.thread.join()
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            self.fn()
+        if self.final:
+            self.fn()
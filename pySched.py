@@ -0,0 +1,197 @@
+# Deterministic thread interleaving for AVL and ConAVL
+# Threads started by Scheduler.run execute one at a time and only switch at named yield points,
+# the next thread is picked by a seeded random generator, so a schedule can be recorded and replayed.
+
+import random
+import threading
+import time
+
+class Deadlock(Exception):
+    """
+    Raised by Scheduler.run when every unfinished thread is blocked on a lock.
+    """
+    pass
+
+class ScheduleDiverged(Exception):
+    """
+    Raised by Scheduler.run when a replayed schedule picks a thread that cannot run.
+    """
+    pass
+
+class SchedulerAbort(BaseException):
+    """
+    Unwinds the remaining threads once another thread has failed.
+    """
+    pass
+
+class Scheduler(object):
+
+    def __init__(self, seed=None, schedule=None, preempt=0.0):
+        """
+        seed: seeds the choice of the next thread at every yield point
+        schedule: list of thread indices to replay (see choices), overrides seed
+        preempt: probability that a thread not started by run gives up the GIL at a yield point
+        """
+        self.random = random.Random(seed)
+        self.schedule = schedule
+        self.preempt = preempt
+        self.trace = []  # (yield point, next thread) of every switch
+        self.cond = threading.Condition()
+        self.threads = {}  # thread ident -> index
+        self.blocked = {}  # index -> lock
+        self.finished = set()
+        self.current = None
+        self.count = 0
+        self.error = None
+
+    def choices(self):
+        """
+        Returns the recorded schedule, pass it as Scheduler(schedule=...) to replay the run.
+        """
+        return [nxt for name, nxt in self.trace]
+
+    def point(self, name):
+        """
+        Named yield point: lets the scheduler switch to another thread.
+        """
+        tid = self.threads.get(threading.get_ident())
+        if tid is None:
+            if self.preempt and self.random.random() < self.preempt:
+                time.sleep(0)
+            return
+        with self.cond:
+            self.__switch(name)
+            self.__wait(tid)
+
+    def Lock(self):
+        """
+        Returns a lock whose contention is resolved by the scheduler.
+        """
+        return SchedLock(self)
+
+    def run(self, fns):
+        """
+        Runs every function of fns in its own thread under the scheduler.
+        Raises the first exception of any thread, or Deadlock.
+        """
+        self.count = len(fns)
+        ready = threading.Barrier(self.count + 1)
+
+        def body(i, fn):
+            self.threads[threading.get_ident()] = i
+            ready.wait()
+            try:
+                with self.cond:
+                    self.__wait(i)
+                fn()
+            except SchedulerAbort:
+                pass
+            except BaseException as e:
+                with self.cond:
+                    if self.error is None:
+                        self.error = e
+                    self.cond.notify_all()
+            finally:
+                with self.cond:
+                    self.finished.add(i)
+                    if self.error is None and self.current == i:
+                        self.__switch("exit")
+
+        tpool = [threading.Thread(target=body, args=(i, fn)) for i, fn in enumerate(fns)]
+        for t in tpool:
+            t.start()
+        ready.wait()
+        with self.cond:
+            self.__switch("start")
+        for t in tpool:
+            t.join()
+        self.threads = {}
+        if self.error is not None:
+            raise self.error
+
+    def block(self, lock):
+        """
+        Called by a thread that must wait for lock: yields until lock is released.
+        """
+        tid = self.threads[threading.get_ident()]
+        with self.cond:
+            if not lock.locked():
+                # released before we got here
+                return
+            self.blocked[tid] = lock
+            self.__switch("blocked")
+            self.__wait(tid)
+
+    def unblock(self, lock):
+        """
+        Makes the threads waiting for lock runnable again.
+        """
+        with self.cond:
+            for tid in [tid for tid, l in self.blocked.items() if l is lock]:
+                del self.blocked[tid]
+
+    def __wait(self, tid):
+        while self.current != tid:
+            if self.error is not None:
+                raise SchedulerAbort()
+            self.cond.wait()
+        if self.error is not None:
+            raise SchedulerAbort()
+
+    def __switch(self, name):
+        """
+        Picks the next thread to run, must be called holding cond.
+        """
+        runnable = [i for i in range(self.count) if i not in self.finished and i not in self.blocked]
+        if not runnable:
+            if len(self.finished) < self.count and self.error is None:
+                self.error = Deadlock("all threads blocked, schedule %s" % (self.choices(),))
+            self.current = None
+        elif self.schedule is not None and len(self.trace) < len(self.schedule):
+            nxt = self.schedule[len(self.trace)]
+            if nxt not in runnable:
+                self.error = ScheduleDiverged("step %d: thread %s cannot run" % (len(self.trace), nxt))
+                self.current = None
+            else:
+                self.trace.append((name, nxt))
+                self.current = nxt
+        else:
+            nxt = runnable[0] if self.schedule is not None else self.random.choice(runnable)
+            self.trace.append((name, nxt))
+            self.current = nxt
+        self.cond.notify_all()
+
+class SchedLock(object):
+    """
+    Drop-in replacement of threading.Lock for threads run by a Scheduler:
+    acquiring is a yield point, and a thread blocked on the lock is not scheduled until it is released.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        sched = self.scheduler
+        if threading.get_ident() not in sched.threads:
+            return self.lock.acquire(blocking, timeout)
+        sched.point("acquire")
+        while not self.lock.acquire(False):
+            if not blocking:
+                return False
+            sched.block(self)
+        return True
+
+    def release(self):
+        self.lock.release()
+        self.scheduler.unblock(self)
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
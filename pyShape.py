@@ -0,0 +1,115 @@
+# Sampled shape diagnostics for AVL and ConAVL, with a monitor that rebuilds a tree whose depth drifted
+# Statistics are estimated from random root-to-leaf descents (Knuth's estimator): a descent that took
+# branching factors b1, b2, ... stands for b1 * b2 * ... nodes at each depth, so averaging the weighted
+# sums over descents estimates the node count, the depth sum and the routing node count without a full walk.
+# Reference: Knuth, Estimating the efficiency of backtrack programs, Mathematics of Computation 29 (1975)
+
+import math
+import random
+
+from pyConAVL import ConAVL
+from pyPeriodic import PeriodicTask
+
+class ShapeStats(object):
+    """
+    Estimated shape of a tree. Depths count the nodes visited by a search, the root is at depth 1.
+    """
+    def __init__(self, samples, nodes, depthSum, routing, maxDepth):
+        self.samples = samples
+        self.nodes = nodes  # estimated number of nodes, routing nodes included
+        self.keys = nodes - routing  # estimated number of keys
+        self.maxDepth = maxDepth  # deepest leaf reached by a descent
+        self.avgDepth = depthSum / nodes if nodes else 0.0  # estimated mean depth of a node
+        self.optimal = math.log2(self.keys + 1) if self.keys > 0 else 0.0  # depth of a perfectly balanced tree
+        self.ratio = maxDepth / self.optimal if self.optimal else 1.0
+        self.deadFraction = routing / nodes if nodes else 0.0  # estimated fraction of routing nodes
+
+    def __repr__(self):
+        return "ShapeStats(keys=%.0f, maxDepth=%d, avgDepth=%.2f, optimal=%.2f, ratio=%.2f, deadFraction=%.3f)" % (
+            self.keys, self.maxDepth, self.avgDepth, self.optimal, self.ratio, self.deadFraction)
+
+def shapeStats(tree, samples=256, rnd=random):
+    """
+    Estimates the shape of an AVL or ConAVL from samples random descents, in O(samples * depth).
+    A ConAVL is not locked: descents racing with writers only skew the estimate.
+    """
+    droot = tree.root.right if isinstance(tree, ConAVL) else tree.root
+    nodes = 0
+    depthSum = 0
+    routing = 0
+    maxDepth = 0
+    for i in range(samples if droot is not None else 0):
+        dnode = droot
+        weight = 1
+        depth = 1
+        while True:
+            nodes += weight
+            depthSum += weight * depth
+            if dnode.val is None:
+                routing += weight
+            children = [c for c in (dnode.left, dnode.right) if c is not None]
+            if not children:
+                break
+            weight *= len(children)
+            dnode = rnd.choice(children)
+            depth += 1
+        maxDepth = max(maxDepth, depth)
+    if samples and droot is not None:
+        nodes /= samples
+        depthSum /= samples
+        routing /= samples
+    return ShapeStats(samples, nodes, depthSum, routing, maxDepth)
+
+def depthPolicy(ratio=1.5, dead=None, min_keys=1024):
+    """
+    Returns a policy asking for a rebuild once the sampled max depth exceeds ratio times log2(n),
+    or the routing node fraction exceeds dead (if given). Trees under min_keys keys are left alone.
+    An AVL tree is never deeper than 1.44 log2(n).
+    """
+    def policy(stats):
+        if stats.keys < min_keys:
+            return False
+        return stats.ratio > ratio or (dead is not None and stats.deadFraction > dead)
+    return policy
+
+class ShapeMonitor(object):
+
+    def __init__(self, tree, policy=None, action=None, interval=1.0, samples=256):
+        """
+        Samples the shape of tree and calls action() (tree.rebuild by default) when policy(stats) is true,
+        policy defaults to depthPolicy(). ConAVL.rebuild is safe to run next to writers, ConAVL.compact and
+        AVL.rebuild are not: with these, only call check() where no writer runs.
+        """
+        self.tree = tree
+        self.policy = depthPolicy() if policy is None else policy
+        self.action = tree.rebuild if action is None else action
+        self.interval = interval
+        self.samples = samples
+        self.rnd = random.Random()
+        self.last = None  # ShapeStats of the last check
+        self.rebuilds = 0
+        self.task = None
+
+    def check(self):
+        """
+        Samples the tree once and rebuilds it if the policy asks for it, returns the ShapeStats.
+        """
+        stats = shapeStats(self.tree, self.samples, self.rnd)
+        self.last = stats
+        if self.policy(stats):
+            self.action()
+            self.rebuilds += 1
+        return stats
+
+    def start(self):
+        """
+        Starts a background thread that calls check() every interval seconds.
+        """
+        if self.task is None:
+            self.task = PeriodicTask(self.check, self.interval).start()
+
+    def stop(self):
+        if self.task is not None:
+            task = self.task
+            self.task = None
+            task.stop()
@@ -0,0 +1,140 @@
+# Time-to-live entries on top of ConAVL
+# Values are stored as Entry(val, deadline) in a ConAVL, and a second ConAVL indexes the keys by
+# deadline tick, so an expiry pass only visits the ticks that are due: O(expired * log n).
+
+import time
+
+from pyConAVL import ConAVL
+from pyPeriodic import PeriodicTask
+
+class Entry(object):
+    """
+    Value stored in the main tree. Entries compare by identity,
+    so remove_if(key, entry) only removes this very write.
+    """
+    __slots__ = ("val", "deadline")
+
+    def __init__(self, val, deadline):
+        self.val = val
+        self.deadline = deadline  # None means the entry never expires
+
+class TTLConAVL(object):
+
+    def __init__(self, resolution=0.01, clock=time.monotonic, **kwargs):
+        """
+        resolution is the width (seconds) of a deadline tick in the expiry index,
+        kwargs are passed to the ConAVL trees. profiler only applies to the main tree, and store
+        is rejected: the trees hold Entry objects and key lists, not encodable values.
+        """
+        if "store" in kwargs:
+            raise TypeError("TTLConAVL does not support a value store")
+        self.tree = ConAVL(**kwargs)
+        kwargs.pop("profiler", None)
+        self.expiries = ConAVL(**kwargs)  # tick -> list of keys that expire in that tick
+        self.resolution = resolution
+        self.clock = clock
+        self.expirer = None
+
+    def get(self, key):
+        """
+        Returns the value of key, or None if it is not present or expired.
+        An expired entry found here is removed.
+        """
+        entry = self.tree.get(key)
+        if entry is None:
+            return None
+        if entry.deadline is not None and entry.deadline <= self.clock():
+            self.tree.remove_if(key, entry)
+            return None
+        return entry.val
+
+    def put(self, key, val = None, ttl = None):
+        """
+        Inserts or updates key, the entry expires ttl seconds from now (never if ttl is None).
+        """
+        deadline = None if ttl is None else self.clock() + ttl
+        self.tree.put(key, Entry(str(key) if val is None else val, deadline))
+        if deadline is not None:
+            self.expiries.compute(self.__tick(deadline), lambda keys: self.__append(keys, key))
+
+    def remove(self, key):
+        """
+        Removes key, its expiry index entry is skipped by the next expiry pass.
+        """
+        self.tree.remove(key)
+
+    def range(self, lo=None, hi=None):
+        """
+        Returns the unexpired (key, value) pairs with lo <= key < hi, see ConAVL.range.
+        """
+        now = self.clock()
+        return [(key, entry.val) for key, entry in self.tree.range(lo, hi) if entry.deadline is None or entry.deadline > now]
+
+    def expire(self):
+        """
+        Removes the entries whose deadline tick has ended, returns the number of removed entries.
+        Routing nodes with fewer than two children are unlinked like after any ConAVL remove: at once,
+        or by the rebalance that ends the pass in deferred mode. Routing nodes with two children stay,
+        see compact.
+        """
+        now = self.clock()
+        removed = 0
+        # only ticks that ended before now: every deadline in their buckets has passed
+        for tick, bucket in self.expiries.range(None, self.__tick(now)):
+            # take the whole bucket, a writer that loses the race opens a new one
+            taken = []
+            self.expiries.compute(tick, lambda keys: self.__take(keys, taken))
+            for key in (taken[0] or []):
+                expired = []
+                self.tree.compute(key, lambda entry: self.__expire(entry, now, expired))
+                removed += len(expired)
+        self.tree.rebalance()
+        self.expiries.rebalance()
+        return removed
+
+    def compact(self):
+        """
+        Runs an expiry pass and compacts both trees, which also drops the routing nodes that expire()
+        leaves behind. Returns the number of removed entries.
+        Must not run concurrently with writers or the expiry thread, see ConAVL.compact.
+        """
+        removed = self.expire()
+        self.tree.compact()
+        self.expiries.compact()
+        return removed
+
+    def start_expiry(self, interval=1.0):
+        """
+        Starts a background thread that calls expire() every interval seconds.
+        """
+        if self.expirer is not None:
+            return
+        self.expirer = PeriodicTask(self.expire, interval).start()
+
+    def stop_expiry(self):
+        if self.expirer is not None:
+            task = self.expirer
+            self.expirer = None
+            task.stop()
+
+    def __tick(self, deadline):
+        return int(deadline / self.resolution)
+
+    def __expire(self, entry, now, expired):
+        # runs under the node lock of the key, the entry may have been rewritten with a later deadline
+        if entry is not None and entry.deadline is not None and entry.deadline <= now:
+            expired.append(entry)
+            return None
+        return entry
+
+    def __take(self, keys, taken):
+        # runs under the bucket node lock, records the bucket and returns None so that compute removes it
+        taken.append(keys)
+        return None
+
+    def __append(self, keys, key):
+        # runs under the bucket node lock, mutating the list in place leaves the tree unchanged
+        if keys is None:
+            return [key]
+        keys.append(key)
+        return keys
@@ -0,0 +1,94 @@
+# Value stores for ConAVL
+# A store turns the value given to the tree into the reference kept in Node.val (encode), and back
+# into the value returned to readers (decode). References replaced or removed by a write are
+# passed to release, which only does the size accounting: readers may still hold the old value.
+
+import threading
+
+# Node.val of every key in a KeySet tree
+PRESENT = True
+
+class KeySet(object):
+    """
+    Keys-only mode: no value object is stored, every present key reads as PRESENT.
+    """
+
+    def encode(self, key, val):
+        return PRESENT
+
+    def decode(self, ref):
+        return PRESENT
+
+    def release(self, ref):
+        pass
+
+class Arena(object):
+    """
+    Keeps bytes-like values back to back in shared buffers of chunk_size bytes (larger values get
+    a buffer of their own), and decodes them as memoryview slices without copying.
+    A reference is a single int: buffer index << 64 | offset << 32 | length.
+    Released space is only accounted for and never reused: a reader may decode a reference after the
+    write that replaced it released it. The arena therefore grows with every write, updates included,
+    until it is dropped; stats() tells live from allocated bytes, and copying the items into a tree
+    with a new Arena reclaims the difference.
+    """
+
+    def __init__(self, chunk_size=1 << 20):
+        self.chunkSize = chunk_size
+        self.chunks = []  # bytearrays, never resized once a value was decoded from them
+        self.views = []  # memoryview of each chunk
+        self.offset = chunk_size  # first free byte of the last chunk
+        self.lock = threading.Lock()
+        self.allocated = 0  # bytes of all chunks
+        self.used = 0  # bytes written
+        self.released = 0  # bytes of the released values
+
+    def encode(self, key, val):
+        """
+        Copies val into the arena, None stores str(key) like ConAVL.put.
+        """
+        if val is None:
+            val = str(key).encode()
+        size = len(val)
+        with self.lock:
+            if not self.chunks or self.offset + size > self.chunkSize:
+                self.chunks.append(bytearray(max(size, self.chunkSize)))
+                self.views.append(memoryview(self.chunks[-1]))
+                self.allocated += len(self.chunks[-1])
+                self.offset = 0
+            chunk = len(self.chunks) - 1
+            offset = self.offset
+            self.views[chunk][offset:offset + size] = val
+            self.offset += size
+            self.used += size
+        return chunk << 64 | offset << 32 | size
+
+    def decode(self, ref):
+        """
+        Returns a read-only memoryview of the value.
+        """
+        offset = ref >> 32 & 0xffffffff
+        return self.views[ref >> 64][offset:offset + (ref & 0xffffffff)].toreadonly()
+
+    def release(self, ref):
+        with self.lock:
+            self.released += ref & 0xffffffff
+
+    def live(self):
+        """
+        Returns the number of bytes of the values still referenced by the tree.
+        """
+        return self.used - self.released
+
+    def stats(self):
+        """
+        Returns a dict of byte counts: allocated (all buffers), used (every value ever written),
+        live (values still referenced) and dead (released values, never reused).
+        """
+        with self.lock:
+            return {
+                "allocated": self.allocated,
+                "used": self.used,
+                "live": self.used - self.released,
+                "dead": self.released,
+            }